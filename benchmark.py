@@ -0,0 +1,521 @@
+"""
+Benchmarks of the scrape -> parse -> query pipeline.
+
+Pages are served by a local stand-in for rauminfo (Rauminfo.do and RauminfoPre.do), either recorded ones
+from a response archive (see response_archive.py) or synthetic ones, for a campus of --rooms rooms.
+Results are written as JSON, and compared against a previous run with --baseline.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import clock
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# factor by which the median of a benchmark may grow before it counts as regression
+REGRESSION_THRESHOLD = 1.2
+
+OCCUPANCY_COLORS = {"free": "#99cc99", "occupied": "#006799", "closed": "#cccccc"}
+INFO_PAGE = (
+    "<html><body><table><tr><td>Rauminfo</td></tr></table><table>"
+    "<tr><td><b>Merkmal</b></td><td></td><td>Wert</td></tr>"
+    "<tr><td><b>Raumtyp</b></td><td>:</td><td>{kind}</td></tr>"
+    "<tr><td><b>Sitzplätze</b></td><td>:</td><td>{seats}</td></tr>"
+    "</table></body></html>"
+)
+WEEK_TEXT = re.compile(r"\d\d\.\d\d\.\d\d\d\d&nbsp;bis&nbsp;\d\d\.\d\d\.\d\d\d\d")
+
+
+def synthetic_occupancy_page(seed: int) -> str:
+    """
+    Generates an occupancy page laid out like those of rauminfo: a frame of two columns and one row,
+    and one cell (spanning several quarter-hours) per class, free or closed period
+    """
+    rnd = random.Random(seed)
+    out = [
+        "<html><body><table><tr><td>Rauminfo</td></tr></table>",
+        "<p>01.01.2024&nbsp;bis&nbsp;07.01.2024</p><table>",
+        "<tr><td bgcolor='white'></td><td bgcolor='white'></td>",
+        *(f"<td bgcolor='white'>Tag {d}</td>" for d in range(7)),
+        "</tr>",
+    ]
+    # per day, the cells starting at each quarter-hour
+    days = []
+    for day in range(7):
+        cells = {}
+        slot = 0
+        while slot < 60:
+            span = min(rnd.randint(1, 8), 60 - slot)
+            kind = "closed" if day >= 5 else rnd.choice(["free", "occupied", "occupied", "closed"])
+            cells[slot] = (span, kind, f"Vorlesung {rnd.randint(1, 500)}" if kind == "occupied" else None)
+            slot += span
+        days.append(cells)
+    for slot in range(60):
+        out.append(f"<tr><td bgcolor='white'>{7 + slot // 4}:{slot % 4 * 15:02d}</td><td bgcolor='white'></td>")
+        for cells in days:
+            if slot in cells:
+                span, kind, title = cells[slot]
+                content = f"<font color='#ffffff'>{title}</font><br><font color='#dddddd'>D-INFK</font>" if title else ""
+                out.append(f"<td bgcolor='{OCCUPANCY_COLORS[kind]}' rowspan='{span}'>{content}</td>")
+        out.append("</tr>")
+    out.append("</table></body></html>")
+    return "".join(out)
+
+
+class Fixtures:
+    """
+    The campus of the benchmark: rooms, located buildings and the pages served for them
+    """
+
+    def __init__(self, rooms: int, buildings: int, archive: Optional[Path] = None, seed: int = 0):
+        from locate_buildings import LocatedBuilding
+        from parse_occupancy import Room
+
+        rnd = random.Random(seed)
+        self.occupancy_pages: List[str] = []
+        self.info_pages: List[str] = []
+        self.source = "synthetic"
+        if archive is not None and archive.exists():
+            from response_archive import ResponseArchive
+
+            # the pages were recorded from rauminfo, not from the stand-in
+            for key, site in ResponseArchive(archive).texts():
+                if key.startswith("POST ") and "/Rauminfo/Rauminfo.do" in key:
+                    self.occupancy_pages.append(site)
+                elif key.startswith("GET ") and "/RauminfoPre.do?" in key:
+                    self.info_pages.append(site)
+            if self.occupancy_pages:
+                self.source = str(archive)
+        if not self.occupancy_pages:
+            self.occupancy_pages = [synthetic_occupancy_page(seed + i) for i in range(min(rooms, 500))]
+        if not self.info_pages:
+            self.info_pages = [
+                INFO_PAGE.format(kind=rnd.choice(["Seminarraum", "Hörsaal", "Computerraum"]), seats=rnd.randint(10, 400))
+                for _ in range(100)
+            ]
+        self.buildings = [
+            LocatedBuilding(
+                name=f"B{i:02d}",
+                street=f"Rämistrasse {i + 1}",
+                zip="8092",
+                city="Zürich",
+                # around the main building, within ~1.5km
+                lat=47.3763 + rnd.uniform(-0.01, 0.01),
+                lon=8.5480 + rnd.uniform(-0.015, 0.015),
+            )
+            for i in range(buildings)
+        ]
+        self.rooms = [
+            Room("Z", "Z", b.name, "G", str(i), name=f"{b.name} G {i}")
+            for i in range(rooms) for b in [self.buildings[i % buildings]]
+        ]
+        self._page_of = {(r.gebaeude, r.raumNr): i for i, r in enumerate(self.rooms)}
+
+    def occupancy_page(self, gebaeude: str, raum: str, day: date) -> str:
+        i = self._page_of.get((gebaeude, raum), 0)
+        monday = day - timedelta(days=day.weekday())
+        week = f"{monday:%d.%m.%Y}&nbsp;bis&nbsp;{monday + timedelta(days=6):%d.%m.%Y}"
+        # recorded pages show the week they were recorded in, serve them as the requested one
+        return WEEK_TEXT.sub(week, self.occupancy_pages[i % len(self.occupancy_pages)], count=1)
+
+    def info_page(self, gebaeude: str, raum: str) -> str:
+        return self.info_pages[self._page_of.get((gebaeude, raum), 0) % len(self.info_pages)]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of parse_occupancy and parse_room_info with the pages of the fixtures of the server
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: str, status: int = 200):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        from parse_occupancy import MONTH_TO_DAY
+
+        if not self.path.startswith("/Rauminfo/Rauminfo.do"):
+            return self._send("", 404)
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode()).items()}
+        month = {v: k for k, v in MONTH_TO_DAY.items()}[form["monat"]]
+        day = date(int(form["jahr"]), month, int(form["tag"]))
+        self._send(self.server.fixtures.occupancy_page(form["gebaeude"], form["raumNr"], day))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.startswith("/RauminfoPre.do"):
+            return self._send("", 404)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self._send(self.server.fixtures.info_page(query["gebaeude"], query["raumNr"]))
+
+
+def stand_in_server(fixtures: Optional[Fixtures] = None) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    threading.Thread(target=server.serve_forever, name="stand-in rauminfo", daemon=True).start()
+    return server
+
+
+def summary(samples: List[float], items: int = 1) -> Dict[str, float]:
+    """
+    Summarizes the seconds of repeated runs that each processed items
+    """
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "items": items,
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "min": samples[0],
+        "max": samples[-1],
+        "p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        "items_per_second": items / statistics.median(samples) if statistics.median(samples) > 0 else float("inf"),
+    }
+
+
+def measure(func: Callable[[], object], repeat: int, items: int = 1) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - begin)
+    return summary(samples, items)
+
+
+@contextlib.contextmanager
+def workdir(path: Path):
+    """
+    Runs the enclosed benchmark with a fresh .cache in path
+    """
+    from cache import reset_caches
+
+    path.mkdir(parents=True)
+    previous = os.getcwd()
+    os.chdir(path)
+    reset_caches()
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+        reset_caches()
+
+
+def bench_parsing(fixtures: Fixtures, repeat: int) -> Dict[str, Dict[str, float]]:
+    import lxml.html
+    from bs4 import BeautifulSoup
+    from itertools import islice
+    from parse_occupancy import parse_occupancy_page, parse_td, table_to_2d, table_to_2d_lxml, parse_td_lxml
+
+    pages = fixtures.occupancy_pages[:200]
+    soups = [BeautifulSoup(site, features="lxml").find_all("table")[1] for site in pages]
+    cells = [td for table in soups for td in table.find_all("td")]
+    trees = [next(islice(lxml.html.fromstring(site).iter("table"), 1, None)) for site in pages]
+    return {
+        "parse_td": measure(lambda: [parse_td(td) for td in cells], repeat, len(cells)),
+        "table_to_2d": measure(lambda: [table_to_2d(t, parse_td) for t in soups], repeat, len(soups)),
+        "table_to_2d_lxml": measure(lambda: [table_to_2d_lxml(t, parse_td_lxml) for t in trees], repeat, len(trees)),
+        "parse_occupancy_page": measure(lambda: [parse_occupancy_page(site) for site in pages], repeat, len(pages)),
+    }
+
+
+def bench_room_occupancy(fixtures: Fixtures, day: date, repeat: int) -> Dict[str, Dict[str, float]]:
+    from cache import Cache
+    from parse_occupancy import occupancy_cache, occupancy_key, room_occupancy
+    from parse_room_list import all_rooms
+
+    rooms = fixtures.rooms[:100]
+    results = {
+        # fetch from the stand-in and parse, one room after the other
+        "room_occupancy_uncached": measure(lambda: [room_occupancy(r, day, cache=None) for r in rooms], repeat, len(rooms)),
+    }
+    for r in rooms:
+        room_occupancy(r, day)
+    results["room_occupancy_memory"] = measure(lambda: [room_occupancy(r, day) for r in rooms], repeat, len(rooms))
+
+    def load_from_disk():
+        # a fresh cache has nothing in memory, so every entry is unpickled
+        cache = Cache(occupancy_cache().cache_dir)
+        return [cache.load(occupancy_key(r, day)) for r in rooms]
+
+    results["occupancy_pickle_load"] = measure(load_from_disk, repeat, len(rooms))
+
+    all_rooms.cache.store("ROOM_LIST", fixtures.rooms)
+    results["room_list_pickle_load"] = measure(lambda: Cache(all_rooms.cache.cache_dir).load("ROOM_LIST"), repeat)
+    return results
+
+
+def bench_freiraum(fixtures: Fixtures, at: datetime, repeat: int) -> Dict[str, Dict[str, float]]:
+    import freiraum
+    from contextlib import closing
+    from database import connect, store_rooms
+
+    with closing(connect()) as db:
+        store_rooms(db, fixtures.rooms)
+    buildings = {b.name for b in fixtures.buildings}
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        # the first run fetches and stores the occupancy of every room of the campus
+        results = {"freiraum_main_cold": measure(lambda: freiraum.main(buildings, at), 1, len(fixtures.rooms))}
+        results["freiraum_main_warm"] = measure(lambda: freiraum.main(buildings, at), repeat, len(fixtures.rooms))
+        results["freiraum_main_minutes_warm"] = measure(
+            lambda: freiraum.main(buildings, at, minutes=60), repeat, len(fixtures.rooms)
+        )
+    # a fresh interpreter answering one building from the snapshot, including all of its imports
+    command = [
+        sys.executable, str(Path(__file__).resolve().with_name("freiraum.py")),
+        fixtures.buildings[0].name, "--at", f"{at:%H:%M}",
+    ]
+    results["freiraum_cli_warm"] = measure(
+        lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL), repeat
+    )
+    return results
+
+
+class _Message:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+
+class _Bot:
+    """
+    Counts the messages the handlers send instead of sending them to telegram
+    """
+
+    def __init__(self):
+        self.messages = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages += 1
+        return _Message(self.messages)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        pass
+
+    def send_location(self, **kwargs):
+        self.messages += 1
+
+
+class _Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def use_fixture_buildings(fixtures: Fixtures):
+    """
+    Makes the queries use the buildings of the fixtures instead of fetching and locating the real ones
+    """
+    import queries
+    from name_index import BuildingNameIndex
+    from resident import Resident
+    from spatial_index import BuildingIndex
+
+    queries.BUILDING_NAMES = Resident("building names", lambda: BuildingNameIndex(fixtures.buildings), lambda: None)
+    queries.BUILDING_INDEX = Resident("building index", lambda: BuildingIndex(fixtures.buildings), lambda: None)
+    queries.ROOM_ATTRIBUTES.reload()
+    queries.FREE_MATRIX.reload()
+
+
+def store_campus(fixtures: Fixtures):
+    """
+    Stores the occupancies of all rooms and the campus grid of this week, like the crawler
+    """
+    import queries
+    from contextlib import closing
+    from crawler import store_campus_grid
+    from database import connect, store_rooms, sync_occupancy
+
+    today = clock.today()
+    with closing(connect()) as db:
+        store_rooms(db, fixtures.rooms)
+        sync_occupancy(db, fixtures.rooms, today)
+        store_campus_grid(db, today)
+    queries.ROOM_ATTRIBUTES.reload()
+    queries.FREE_MATRIX.reload()
+
+
+def bench_query_server(fixtures: Fixtures, repeat: int) -> Dict[str, Dict[str, float]]:
+    """
+    Measures round trips to the query server, answered from its response cache or computed
+    """
+    import query_server
+    from query_client import QueryClient
+
+    use_fixture_buildings(fixtures)
+    store_campus(fixtures)
+    server = query_server.serve(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = QueryClient(f"http://127.0.0.1:{server.server_port}")
+    now = clock.now()
+    buildings = {b.name for b in fixtures.buildings[:3]}
+
+    def free():
+        return list(client.free_rooms_in_buildings(buildings, now))
+
+    def nearest():
+        return list(client.nearest_free_rooms(47.3763, 8.5480, now))
+
+    # the first requests compute the responses, the measured ones are answered from the response cache
+    free()
+    nearest()
+    results = {
+        "query_free_cached": measure(free, repeat),
+        "query_nearest_cached": measure(nearest, repeat),
+    }
+
+    def uncached():
+        query_server.RESPONSE_CACHE = query_server.ResponseCache()
+        return free()
+
+    results["query_free_computed"] = measure(uncached, repeat)
+    server.shutdown()
+    return results
+
+
+def bench_handle_location(fixtures: Fixtures, repeat: int) -> Dict[str, Dict[str, float]]:
+    try:
+        import freiraumbot
+    except ImportError as e:
+        # the bot needs a secrets.py with its token, see secrets.template.py
+        __LOGGER__.warning(f"Skipping handle_location: {e}")
+        return {"handle_location": {"skipped": str(e)}}
+    from contextlib import closing
+    from database import connect, store_rooms, sync_occupancy, sync_room_infos
+
+    with closing(connect()) as db:
+        store_rooms(db, fixtures.rooms)
+    use_fixture_buildings(fixtures)
+    location = {"latitude": 47.3763, "longitude": 8.5480}
+
+    def request(text: Optional[str] = None, chat_data: Optional[dict] = None) -> dict:
+        chat_data = chat_data if chat_data is not None else {}
+        update = _Namespace(
+            message=_Namespace(text=text, location=None if text else location),
+            effective_chat=_Namespace(id=1),
+            effective_user=_Namespace(id=1),
+        )
+        freiraumbot.handle_location(update, _Namespace(bot=_Bot(), user_data={}, chat_data=chat_data))
+        return chat_data
+
+    results = {
+        # fetches the occupancies of the nearest buildings only
+        "handle_location_cold": measure(request, 1),
+        "handle_location_database": measure(request, repeat),
+    }
+    # the following pages read stored rooms too, instead of fetching the rooms further away
+    with closing(connect()) as db:
+        sync_occupancy(db, fixtures.rooms, clock.today())
+        sync_room_infos(db, fixtures.rooms)
+    chat_data = request()
+    results["handle_location_more_database"] = measure(lambda: request("/more", chat_data), repeat)
+
+    # the crawler stores a grid of the whole campus, which the bot answers from
+    store_campus(fixtures)
+    results["handle_location_matrix"] = measure(request, repeat)
+    chat_data = request()
+    results["handle_location_more_matrix"] = measure(lambda: request("/more", chat_data), repeat)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    """
+    Returns the benchmarks whose median grew by more than threshold compared to baseline
+    """
+    regressions = []
+    for name, stats in results.items():
+        previous = baseline.get(name, {})
+        if "median" in stats and previous.get("median"):
+            ratio = stats["median"] / previous["median"]
+            if ratio > threshold:
+                regressions.append(f"{name}: {previous['median']:.4f}s -> {stats['median']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+
+def run(args) -> dict:
+    server = stand_in_server()
+    # the parsers read the location of rauminfo on import, so they are only imported from here on
+    os.environ["FREIRAUM_RAUMINFO_URL"] = f"http://127.0.0.1:{server.server_port}"
+    fixtures = server.fixtures = Fixtures(args.rooms, args.buildings, args.archive)
+
+    from http_client import CLIENT
+
+    # measure the pipeline, not the politeness towards rauminfo
+    CLIENT.rate = CLIENT.burst = 1e6
+    CLIENT.max_per_host = 64
+
+    today = clock.today()
+    at = datetime.combine(today - timedelta(days=today.weekday()), datetime.min.time()) + timedelta(hours=10)
+    root = Path(tempfile.mkdtemp(prefix="freiraum-benchmark-"))
+    results = {}
+    with workdir(root.joinpath("parsing")):
+        results.update(bench_parsing(fixtures, args.repeat))
+    with workdir(root.joinpath("room_occupancy")):
+        results.update(bench_room_occupancy(fixtures, at.date(), args.repeat))
+    with workdir(root.joinpath("freiraum")):
+        results.update(bench_freiraum(fixtures, at, args.repeat))
+    with workdir(root.joinpath("handle_location")):
+        results.update(bench_handle_location(fixtures, args.repeat))
+    with workdir(root.joinpath("query_server")):
+        results.update(bench_query_server(fixtures, args.repeat))
+    server.shutdown()
+    return {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rooms": len(fixtures.rooms),
+            "buildings": len(fixtures.buildings),
+            "fixtures": fixtures.source,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Benchmarks the scrape -> parse -> query pipeline.")
+    parser.add_argument("--rooms", type=int, default=2000, help="Number of rooms of the campus.")
+    parser.add_argument("--buildings", type=int, default=100, help="Number of buildings of the campus.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per benchmark.")
+    parser.add_argument("--archive", type=lambda x: Path(x).resolve(), default=Path(".cache/archive").resolve(),
+                        help="Response archive with recorded pages, synthetic pages are used if it does not exist.")
+    parser.add_argument("--output", type=Path, help="File to write the results to, defaults to stdout.")
+    parser.add_argument("--baseline", type=Path, help="Results of a previous run to compare against.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Factor by which a median may grow before it counts as regression.")
+    args = parser.parse_args()
+    report = run(args)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        regressions = compare(report["results"], json.loads(args.baseline.read_text())["results"], args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
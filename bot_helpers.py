@@ -0,0 +1,138 @@
+import logging
+import time
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from metrics import span
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# telegram rejects longer messages
+MESSAGE_LIMIT = 4096
+# seconds between two edits of the same message, telegram throttles chats that are edited more often
+EDIT_INTERVAL = 1.0
+# answer to a request that was replaced by a newer one of the same user before it ran
+SUPERSEDED_TEXT = "Ich beantworte nur deine neueste Anfrage, diese hier überspringe ich."
+
+
+class ReplyStream:
+    """
+    Sends the lines of a reply as they arrive in as few messages as possible.
+    Lines are appended to one message that is edited at most every EDIT_INTERVAL seconds,
+    a new message is started once the current one would exceed MESSAGE_LIMIT.
+    """
+
+    def __init__(self, bot, chat_id: int, header: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.count = 0
+        self._lines: List[str] = [header]
+        with span("send", method="send_message"):
+            self._message = bot.send_message(chat_id=chat_id, text=header)
+        self._sent = 1
+        self._last_edit = time.monotonic()
+
+    def add(self, line: str):
+        if len("\n".join(self._lines)) + 1 + len(line) > MESSAGE_LIMIT:
+            self.flush()
+            self._lines = [line]
+            with span("send", method="send_message"):
+                self._message = self.bot.send_message(chat_id=self.chat_id, text=line)
+            self._sent = 1
+            self._last_edit = time.monotonic()
+        else:
+            self._lines.append(line)
+            if time.monotonic() - self._last_edit >= EDIT_INTERVAL:
+                self.flush()
+        self.count += 1
+
+    def flush(self):
+        if self._sent == len(self._lines):
+            # telegram rejects edits that do not change the message
+            return
+        with span("send", method="edit_message_text"):
+            self.bot.edit_message_text(
+                text="\n".join(self._lines), chat_id=self.chat_id, message_id=self._message.message_id
+            )
+        self._sent = len(self._lines)
+        self._last_edit = time.monotonic()
+
+    def close(self, empty: Optional[str] = None):
+        """
+        Sends the remaining lines, and empty if no line was added at all
+        """
+        if self.count == 0 and empty is not None:
+            self._lines.append(empty)
+        self.flush()
+
+
+class Coalescer:
+    """
+    Runs at most one request per key (i.e. per user) at a time.
+    Requests that arrive while one is running replace each other, such that only the latest one runs next
+    and a single user never occupies more than one worker.
+    Replaced requests never run, their superseded callback is called instead (i.e. to tell the user).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # keys with a running request, mapped to the request that runs next and its superseded callback (if any)
+        self._pending: Dict[Hashable, Optional[Tuple[Callable[[], None], Optional[Callable[[], None]]]]] = {}
+
+    def submit(
+        self, key: Hashable, request: Callable[[], None], superseded: Optional[Callable[[], None]] = None
+    ) -> bool:
+        """
+        Runs request in the calling thread, unless a request of key is already running.
+        Returns whether the calling thread ran the request.
+        """
+        with self._lock:
+            running = key in self._pending
+            dropped = self._pending.get(key)
+            self._pending[key] = (request, superseded) if running else None
+        if running:
+            if dropped is not None:
+                __LOGGER__.info(f"Dropping superseded request of {key}")
+                self._notify(key, dropped[1])
+            return False
+        while request is not None:
+            try:
+                request()
+            except Exception as e:
+                __LOGGER__.error(f"Request of {key} failed.", exc_info=e)
+            with self._lock:
+                pending = self._pending.pop(key)
+                if pending is not None:
+                    self._pending[key] = None
+            request = pending[0] if pending is not None else None
+        return True
+
+    @staticmethod
+    def _notify(key: Hashable, superseded: Optional[Callable[[], None]]):
+        if superseded is None:
+            return
+        try:
+            superseded()
+        except Exception as e:
+            __LOGGER__.error(f"Failed to answer the superseded request of {key}.", exc_info=e)
+
+
+def coalesced(coalescer: Coalescer, superseded: str = SUPERSEDED_TEXT):
+    """
+    Decorates a handler such that the requests of each user are coalesced by coalescer,
+    requests replaced by a newer one of the same user are answered with superseded
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def coalesced_handler(update, context):
+            user = update.effective_user.id if update.effective_user is not None else update.effective_chat.id
+            coalescer.submit(
+                user,
+                lambda: handler(update, context),
+                lambda: context.bot.send_message(chat_id=update.effective_chat.id, text=superseded),
+            )
+
+        return coalesced_handler
+
+    return decorator
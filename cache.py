@@ -1,27 +1,320 @@
 from pathlib import Path
+from dataclasses import dataclass
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, Hashable, Optional, TypeVar
+import hashlib
+import logging
+import os
 import pickle
+import tempfile
+import time
 
-def cached(file_name: str, cache_dir=Path(".cache")):
-    def cached_wrapper(func):
-        cache_path = Path(cache_dir)
+from metrics import REGISTRY, span
+
+__LOGGER__ = logging.getLogger(__name__)
+
+T = TypeVar("T")
 
-        def cached_f(*args, **kwargs):
-            try:
-                with cache_path.joinpath(file_name).open("rb") as cache_file:
-                    cf = pickle.load(cache_file)
-                    return cf
-            except (FileNotFoundError, EOFError):
-                pass
 
-            result = func(*args, **kwargs)
+@dataclass
+class CacheEntry:
+    value: Any
+    # time.time() at which the value was computed
+    created: float
 
-            cache_path.mkdir(parents=True, exist_ok=True)
-            with cache_path.joinpath(file_name).open("wb") as cache_file:
-                cf = result
-                pickle.dump(cf, cache_file)
 
+class SingleFlight:
+    """
+    Shares one in-flight call per key between concurrent callers:
+    the first caller of a key runs it, callers arriving meanwhile wait for and share its result (or exception)
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
             return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class Cache:
+    """
+    Two tier cache of pickled values: an in-process LRU in front of one file per key in cache_dir.
+    Entries expire after ttl seconds (never if None), the files in cache_dir are evicted
+    (least recently used first) once they exceed max_bytes.
+    With stale_while_revalidate, expired values are returned immediately while being recomputed in the background.
+    Concurrent computations of the same key are shared, files are replaced atomically.
+    Hits and misses are counted in the metrics under name (the name of cache_dir by default).
+    Files that an earlier version wrote to legacy_dir are moved to cache_dir when they are first loaded.
+    """
+
+    def __init__(
+        self,
+        cache_dir=Path(".cache"),
+        ttl: Optional[float] = None,
+        maxsize: int = 128,
+        max_bytes: Optional[int] = None,
+        stale_while_revalidate: bool = False,
+        name: Optional[str] = None,
+        legacy_dir: Optional[Path] = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.legacy_dir = Path(legacy_dir) if legacy_dir is not None else None
+        self.name = name or self.cache_dir.name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self._memory: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # sizes of the files in cache_dir in order of their last use, scanned on the first write
+        self._disk: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+        self._revalidating = set()
+        self._flights = SingleFlight()
+        self._lock = Lock()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key.replace(os.sep, "_"))
+
+    def expired(self, entry: CacheEntry, ttl: Optional[Callable[[Any], Optional[float]]] = None) -> bool:
+        """
+        Returns whether entry is older than its ttl, which is ttl(value) if given and the ttl of the cache otherwise
+        """
+        entry_ttl = ttl(entry.value) if ttl is not None else self.ttl
+        return entry_ttl is not None and time.time() - entry.created > entry_ttl
+
+    def load(self, key: str) -> Optional[CacheEntry]:
+        """
+        Returns the entry of key from memory or disk, regardless of whether it expired
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._touch(key)
+                return entry
+        try:
+            cache_file = self.path(key).open("rb")
+        except FileNotFoundError:
+            return self._migrate(key)
+        try:
+            with cache_file, span("cache_load", cache=self.name):
+                entry = pickle.load(cache_file)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _migrate(self, key: str) -> Optional[CacheEntry]:
+        if self.legacy_dir is None:
+            return None
+        legacy_path = self.legacy_dir.joinpath(self.path(key).name)
+        try:
+            with legacy_path.open("rb") as cache_file:
+                entry = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if not isinstance(entry, CacheEntry):
+            # files written before entries were introduced only hold the value
+            entry = CacheEntry(entry, legacy_path.stat().st_mtime)
+        self._write(key, entry)
+        legacy_path.unlink(missing_ok=True)
+        return entry
+
+    def forget(self, key: str):
+        """
+        Drops the entry of key from memory, such that the next load reads its file again (i.e. written by another process)
+        """
+        with self._lock:
+            self._memory.pop(key, None)
+
+    def store(self, key: str, value: Any) -> CacheEntry:
+        return self._write(key, CacheEntry(value, time.time()))
+
+    def _write(self, key: str, entry: CacheEntry) -> CacheEntry:
+        self._remember(key, entry)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        # readers (also in other processes) see either the old or the new file, never a partially written one
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with span("cache_store", cache=self.name), os.fdopen(fd, "wb") as cache_file:
+                pickle.dump(entry, cache_file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        if self.max_bytes is not None:
+            self._account(key, path.stat().st_size)
+        return entry
+
+    def _remember(self, key: str, entry: CacheEntry):
+        with self._lock:
+            self._memory[key] = entry
+            self._touch(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def _touch(self, key: str):
+        # marks key as used last in memory and on disk, called with the lock held
+        self._memory.move_to_end(key)
+        if self._disk is not None and self.path(key).name in self._disk:
+            self._disk.move_to_end(self.path(key).name)
+
+    def _account(self, key: str, size: int):
+        name = self.path(key).name
+        with self._lock:
+            if self._disk is None:
+                files = sorted(
+                    (p for p in self.cache_dir.iterdir() if p.is_file() and p.suffix != ".tmp"),
+                    key=lambda p: p.stat().st_mtime,
+                )
+                self._disk = OrderedDict((p.name, p.stat().st_size) for p in files)
+                self._disk_bytes = sum(self._disk.values())
+            self._disk_bytes += size - self._disk.pop(name, 0)
+            self._disk[name] = size
+            while self._disk_bytes > self.max_bytes and len(self._disk) > 1:
+                evicted, evicted_size = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                self.cache_dir.joinpath(evicted).unlink(missing_ok=True)
+                self._memory.pop(evicted, None)
+
+    def get(
+        self,
+        key: str,
+        compute: Callable[[], Any],
+        valid: Callable[[Any], bool] = lambda x: True,
+        refresh: bool = False,
+        ttl: Optional[Callable[[Any], Optional[float]]] = None,
+    ) -> Any:
+        """
+        Returns the cached value of key if it is present, not expired and valid, otherwise computes and stores it.
+        Concurrent callers that miss the same key share a single computation.
+        ttl overrides the ttl of the cache per value, i.e. to keep values that can no longer change forever.
+        """
+        entry = None if refresh else self.load(key)
+        if entry is not None and valid(entry.value):
+            if not self.expired(entry, ttl):
+                REGISTRY.inc("freiraum_cache_requests_total", cache=self.name, result="hit")
+                return entry.value
+            if self.stale_while_revalidate:
+                REGISTRY.inc("freiraum_cache_requests_total", cache=self.name, result="stale")
+                self._revalidate(key, compute)
+                return entry.value
+        REGISTRY.inc("freiraum_cache_requests_total", cache=self.name, result="miss")
+        return self._flights.do(key, lambda: self.store(key, compute())).value
+
+    def _revalidate(self, key: str, compute: Callable[[], Any]):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def revalidate():
+            try:
+                self._flights.do(key, lambda: self.store(key, compute()))
+            except Exception as e:
+                __LOGGER__.warning(f"Failed to revalidate {key}: {e}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        # a revalidation in progress does not keep the process from exiting
+        Thread(target=revalidate, name=f"revalidate {key}", daemon=True).start()
+
+
+_CACHES: Dict[Path, Cache] = {}
+_CACHES_LOCK = Lock()
+
+
+def cache_at(cache_dir: Path, **options) -> Cache:
+    """
+    Returns the cache of cache_dir, which is created with options on the first call.
+    Caches with max_bytes evict any file in cache_dir, so they should own their directory.
+    """
+    cache_dir = Path(cache_dir)
+    with _CACHES_LOCK:
+        if cache_dir not in _CACHES:
+            _CACHES[cache_dir] = Cache(cache_dir, **options)
+        return _CACHES[cache_dir]
+
+
+def reset_caches():
+    """
+    Forgets the caches created by cache_at, i.e. after changing the working directory that relative cache dirs refer to
+    """
+    with _CACHES_LOCK:
+        _CACHES.clear()
+
+
+def argument_key(file_name: str, *args, **kwargs) -> str:
+    """
+    Derives the key of a call from its arguments, just file_name for calls without arguments
+    """
+    if not args and not kwargs:
+        return file_name
+    digest = hashlib.sha1(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+    return f"{file_name}_{digest[:16]}"
+
+
+def cached(
+    file_name: str,
+    cache_dir=Path(".cache").joinpath("cached"),
+    ttl: Optional[float] = None,
+    key: Callable[..., str] = None,
+    maxsize: int = 128,
+    max_bytes: Optional[int] = None,
+    stale_while_revalidate: bool = False,
+    legacy_dir: Optional[Path] = Path(".cache"),
+):
+    """
+    Caches the results of the decorated function in cache_dir, see Cache.
+    Results are keyed by file_name and, if given, the arguments of the call (or key(*args, **kwargs)).
+    cache_dir is a directory of its own, such that max_bytes never evicts the database or the grids in .cache,
+    files of earlier versions, which were written to legacy_dir, are moved there.
+    """
+    def cached_wrapper(func):
+        # the files of decorated functions share cache_dir, so they get their own cache
+        cache = Cache(
+            cache_dir,
+            ttl=ttl,
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            stale_while_revalidate=stale_while_revalidate,
+            name=file_name,
+            legacy_dir=legacy_dir,
+        )
+
+        def call_key(*args, **kwargs):
+            return key(*args, **kwargs) if key is not None else argument_key(file_name, *args, **kwargs)
+
+        def cached_f(*args, **kwargs):
+            return cache.get(call_key(*args, **kwargs), lambda: func(*args, **kwargs))
+
+        def refresh(*args, **kwargs):
+            return cache.get(call_key(*args, **kwargs), lambda: func(*args, **kwargs), refresh=True)
 
+        # bypasses the cache and overwrites it with a fresh result
+        cached_f.refresh = refresh
+        cached_f.cache = cache
         return cached_f
 
     return cached_wrapper
@@ -0,0 +1,87 @@
+import logging
+import os
+from datetime import date, datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Callable
+from zoneinfo import ZoneInfo
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# rauminfo shows local times of the campus, all times are naive datetimes in this timezone
+TIMEZONE = ZoneInfo(os.environ.get("FREIRAUM_TIMEZONE", "Europe/Zurich"))
+
+
+class Clock:
+    """
+    The wall clock of the campus, independent of the timezone of the machine
+    """
+
+    def __init__(self, timezone: ZoneInfo = TIMEZONE):
+        self.timezone = timezone
+
+    def now(self) -> datetime:
+        return datetime.now(self.timezone).replace(tzinfo=None)
+
+    def today(self) -> date:
+        return self.now().date()
+
+
+class FixedClock(Clock):
+    """
+    A clock that only moves when advanced, i.e. to replay a given day
+    """
+
+    def __init__(self, now: datetime):
+        super().__init__()
+        self._now = now
+        self._lock = Lock()
+
+    def now(self) -> datetime:
+        with self._lock:
+            return self._now
+
+    def advance(self, delta: timedelta):
+        with self._lock:
+            self._now += delta
+
+
+_CLOCK: Clock = Clock()
+
+
+def set_clock(clock: Clock):
+    """
+    Replaces the clock that now() and today() read, for the whole process
+    """
+    global _CLOCK
+    _CLOCK = clock
+
+
+def now() -> datetime:
+    return _CLOCK.now()
+
+
+def today() -> date:
+    return _CLOCK.today()
+
+
+def watch_days(on_new_day: Callable[[date, date], None], interval: float = 60.0) -> Event:
+    """
+    Calls on_new_day(previous day, new day) in the background whenever the date changes, checking every interval seconds.
+    Watching stops once the returned event is set.
+    """
+    stopped = Event()
+
+    def watch():
+        previous = today()
+        while not stopped.wait(interval):
+            day = today()
+            if day == previous:
+                continue
+            try:
+                on_new_day(previous, day)
+            except Exception as e:
+                __LOGGER__.error(f"Handling the change of day to {day} failed.", exc_info=e)
+            previous = day
+
+    Thread(target=watch, name="day watch", daemon=True).start()
+    return stopped
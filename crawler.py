@@ -0,0 +1,197 @@
+"""
+Refreshes the room list, room infos and occupancies of the current and next weeks ahead of time,
+such that user requests can be answered from the database without scraping.
+Meant to run nightly, i.e. via cron:
+
+    0 3 * * * cd /path/to/freiraumETHZ && python3 crawler.py --incremental
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from contextlib import closing
+from dataclasses import dataclass, field, asdict
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Callable
+
+from database import (
+    DATABASE_PATH,
+    connect,
+    store_rooms,
+    store_room_info,
+    store_occupancy,
+    missing_rooms,
+    stored_occupancies,
+)
+from http_client import CLIENT
+import clock
+from metrics import REGISTRY
+from free_room import room_key
+from occupancy_grid import CampusGrid, campus_grid_path, week_start
+from parse_occupancy import (
+    Room,
+    MAX_WORKERS,
+    fetch_concurrently,
+    fetch_occupancy_page,
+    parse_occupancy_page,
+    store_room_occupancy,
+)
+from parse_room_info import fetch_room_info_page, parse_room_info_page
+import parse_room_info
+from parse_room_list import all_rooms
+from snapshot import store_snapshot
+
+__LOGGER__ = logging.getLogger(__name__)
+
+STATE_PATH = Path(".cache").joinpath("crawler_state.json")
+
+
+@dataclass
+class CrawlerState:
+    # hash and time of the last fetch of every page
+    pages: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    # pages processed in the current run, used to resume an interrupted run
+    done: List[str] = field(default_factory=list)
+    finished: bool = True
+
+
+def load_state(path: Path = STATE_PATH) -> CrawlerState:
+    try:
+        with path.open() as state_file:
+            return CrawlerState(**json.load(state_file))
+    except FileNotFoundError:
+        return CrawlerState()
+
+
+def save_state(state: CrawlerState, path: Path = STATE_PATH):
+    # write to a temporary file first such that an interrupt never leaves a truncated state
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as state_file:
+        json.dump(asdict(state), state_file)
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class Task:
+    key: str
+    room: Room
+    fetch: Callable[[], str]
+    week: int = None
+
+
+def store_campus_grid(db, day: date):
+    """
+    Stores the stored occupancies of the week of day as one compact file, such that the whole campus can be loaded at once
+    """
+    CampusGrid.from_occupancies(week_start(day), stored_occupancies(db, day)).save(campus_grid_path(day))
+
+
+def crawl(
+    weeks: int = 2,
+    incremental: bool = False,
+    resume: bool = False,
+    max_age: timedelta = timedelta(hours=20),
+    info_max_age: timedelta = timedelta(days=7),
+    checkpoint_every: int = 50,
+    db_path: Path = DATABASE_PATH,
+    state_path: Path = STATE_PATH,
+    max_workers: int = MAX_WORKERS,
+):
+    """
+    Refreshes all_rooms and the room info and occupancy of the next weeks of all rooms.
+    :param weeks: number of weeks to refresh, starting with the current one
+    :param incremental: only refetch pages that were fetched longer ago than max_age (info_max_age for room infos)
+    :param resume: skip pages already processed by a previous, interrupted run
+    :param checkpoint_every: number of pages after which the crawler state is saved
+    """
+    state = load_state(state_path)
+    if not (resume and not state.finished):
+        state.done = []
+    state.finished = False
+    done = set(state.done)
+    now = clock.now()
+    today = clock.today()
+
+    def stale(key: str, age: timedelta):
+        page = state.pages.get(key)
+        return page is None or now - datetime.fromisoformat(page["fetched"]) > age
+
+    with closing(connect(db_path)) as db:
+        __LOGGER__.info("Refreshing room list")
+        rooms = all_rooms.refresh()
+        store_rooms(db, rooms)
+
+        week_days = [week_start(today).date() + timedelta(weeks=week) for week in range(weeks)]
+        # data that is missing from the database is always fetched
+        missing = [{room_key(r) for r in missing_rooms(db, rooms, day)} for day in week_days]
+        tasks = []
+        for room in rooms:
+            # the keys of the crawler state name rooms by their path
+            path = "/".join(room_key(room))
+            key = f"info/{path}"
+            if not (incremental and not stale(key, info_max_age)):
+                tasks.append(Task(key, room, lambda room=room: fetch_room_info_page(room)))
+            for week, day in enumerate(week_days):
+                key = f"occupancy/{path}/{day.isoformat()}"
+                if not (incremental and not stale(key, max_age) and room_key(room) not in missing[week]):
+                    tasks.append(Task(key, room, lambda room=room, day=day: fetch_occupancy_page(room, day), week))
+        tasks = [t for t in tasks if t.key not in done]
+        __LOGGER__.info(f"Fetching {len(tasks)} pages")
+
+        def fetch(task: Task):
+            try:
+                return task.fetch()
+            except Exception as e:
+                # the page is retried in the next run
+                __LOGGER__.warning(f"Failed to fetch {task.key}: {e}")
+                return None
+
+        try:
+            for i, (task, site) in enumerate(fetch_concurrently(fetch, tasks, max_workers)):
+                if site is None:
+                    continue
+                content_hash = hashlib.sha256(site.encode()).hexdigest()
+                page = state.pages.get(task.key)
+                changed = page is None or page["hash"] != content_hash
+                if changed or task.week is not None and room_key(task.room) in missing[task.week]:
+                    try:
+                        if task.week is None:
+                            info = parse_room_info_page(site)
+                            store_room_info(db, task.room, info)
+                            parse_room_info.store_room_info(task.room, info)
+                        else:
+                            week = parse_occupancy_page(site)
+                            store_occupancy(db, task.room, week)
+                            store_room_occupancy(task.room, week)
+                    except Exception as e:
+                        __LOGGER__.warning(f"Failed to parse {task.key}: {e}")
+                        continue
+                    __LOGGER__.info(f"Updated {task.key}")
+                state.pages[task.key] = {"hash": content_hash, "fetched": clock.now().isoformat()}
+                state.done.append(task.key)
+                if (i + 1) % checkpoint_every == 0:
+                    save_state(state, state_path)
+            state.finished = True
+        finally:
+            save_state(state, state_path)
+
+        for day in week_days:
+            store_campus_grid(db, day)
+            # freiraum.py answers from the snapshot without touching the database
+            store_snapshot(db, day)
+    CLIENT.log_stats()
+    REGISTRY.log_summary()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Refreshes the stored rooms and occupancies ahead of time.")
+    parser.add_argument("--weeks", type=int, default=2, help="Number of weeks to fetch, starting with the current one.")
+    parser.add_argument("--incremental", action="store_true", help="Only refetch pages that are stale.")
+    parser.add_argument("--max-age", type=float, default=20, help="Hours after which an occupancy is stale.")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run.")
+    args = parser.parse_args()
+    crawl(weeks=args.weeks, incremental=args.incremental, resume=args.resume, max_age=timedelta(hours=args.max_age))
@@ -0,0 +1,386 @@
+import sqlite3
+from dataclasses import asdict, fields
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from free_room import room_key
+from parse_buildings import Building
+from parse_occupancy import (
+    Room,
+    Class,
+    Occupancy,
+    Timeslot,
+    CachedRoomOccupancy,
+    room_occupancy_weeks,
+    fetch_concurrently,
+    MAX_WORKERS,
+)
+from parse_room_list import all_rooms
+from parse_room_info import RoomAttributes, RoomFilter, room_attributes
+import parse_room_info
+
+DATABASE_PATH = Path(".cache").joinpath("freiraum.sqlite")
+
+ROOM_COLUMNS = [f.name for f in fields(Room)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buildings (
+    name TEXT PRIMARY KEY,
+    street TEXT,
+    zip TEXT,
+    city TEXT,
+    lat REAL,
+    lon REAL
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    id INTEGER PRIMARY KEY,
+    region TEXT NOT NULL,
+    areal TEXT NOT NULL,
+    gebaeude TEXT NOT NULL,
+    geschoss TEXT NOT NULL,
+    raumNr TEXT NOT NULL,
+    name TEXT,
+    rektoratInListe TEXT,
+    raumInRaumgruppe TEXT,
+    UNIQUE (region, areal, gebaeude, geschoss, raumNr)
+);
+CREATE INDEX IF NOT EXISTS rooms_gebaeude ON rooms (gebaeude);
+CREATE TABLE IF NOT EXISTS room_info (
+    room_id INTEGER NOT NULL REFERENCES rooms (id),
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (room_id, key)
+);
+CREATE TABLE IF NOT EXISTS room_attributes (
+    room_id INTEGER PRIMARY KEY REFERENCES rooms (id),
+    kind TEXT,
+    seats INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS weeks (
+    room_id INTEGER NOT NULL REFERENCES rooms (id),
+    begin TEXT NOT NULL,
+    end TEXT NOT NULL,
+    PRIMARY KEY (room_id, begin)
+);
+CREATE TABLE IF NOT EXISTS occupancy (
+    room_id INTEGER NOT NULL REFERENCES rooms (id),
+    begin TEXT NOT NULL,
+    end TEXT NOT NULL,
+    state TEXT NOT NULL,
+    title TEXT,
+    organization TEXT
+);
+-- free rooms are found per room from the occupancies of the day, not by time across all rooms
+DROP INDEX IF EXISTS occupancy_time;
+CREATE INDEX IF NOT EXISTS occupancy_room ON occupancy (room_id, begin);
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+-- attributes are only updated when they changed, see _store_attributes
+CREATE TRIGGER IF NOT EXISTS room_attributes_version AFTER INSERT ON room_attributes BEGIN
+    INSERT INTO versions VALUES ('room_attributes', 1) ON CONFLICT (name) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS room_attributes_changed AFTER UPDATE OF kind, seats ON room_attributes BEGIN
+    INSERT INTO versions VALUES ('room_attributes', 1) ON CONFLICT (name) DO UPDATE SET version = version + 1;
+END;
+"""
+
+
+def _ts(d: datetime) -> str:
+    # iso strings compare in the same order as the datetimes they represent
+    return d.isoformat(sep=" ")
+
+
+def _day(d: date) -> str:
+    return _ts(datetime(d.year, d.month, d.day))
+
+
+def connect(path: Path = DATABASE_PATH) -> sqlite3.Connection:
+    """
+    Opens (and if necessary creates) the occupancy database at path
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path))
+    conn.executescript(SCHEMA)
+    conn.create_function("kind_matches", 2, _kind_matches, deterministic=True)
+    if conn.execute("SELECT 1 FROM room_attributes LIMIT 1").fetchone() is None:
+        # databases created before the attributes were introduced only have the raw room infos
+        with conn:
+            for key, info in stored_room_infos(conn).items():
+                _store_attributes(conn, _room_id(conn, Room(*key)), room_attributes(info))
+    return conn
+
+
+def _kind_matches(kind: Optional[str], part: str) -> bool:
+    # unlike LIKE, also case insensitive for umlauts
+    return part.lower() in (kind or "").lower()
+
+
+def _filter_clause(room_filter: Optional[RoomFilter], room_id: str) -> Tuple[str, list]:
+    """
+    Returns the join restricting the rows to the rooms (with id column room_id) accepted by room_filter
+    """
+    if not room_filter:
+        return "", []
+    clause = f" JOIN room_attributes a ON a.room_id = {room_id} AND a.seats >= ?"
+    params: list = [room_filter.min_seats]
+    kinds = list(room_filter.kinds or [])
+    if kinds:
+        clause += f" AND ({' OR '.join(['kind_matches(a.kind, ?)'] * len(kinds))})"
+        params += kinds
+    return clause, params
+
+
+def store_buildings(conn: sqlite3.Connection, buildings: Iterable[Building]):
+    """
+    Stores buildings, LocatedBuildings additionally store their coordinates
+    """
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO buildings VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (b.name, b.street, b.zip, b.city, getattr(b, "lat", None), getattr(b, "lon", None))
+                for b in buildings
+            ),
+        )
+
+
+def store_rooms(conn: sqlite3.Connection, rooms: Iterable[Room]):
+    with conn:
+        conn.executemany(
+            f"INSERT OR IGNORE INTO rooms ({', '.join(ROOM_COLUMNS)}) VALUES ({', '.join('?' * len(ROOM_COLUMNS))})",
+            (tuple(asdict(r).values()) for r in rooms),
+        )
+
+
+def _room_id(conn: sqlite3.Connection, room: Room) -> int:
+    row = conn.execute(
+        "SELECT id FROM rooms WHERE region = ? AND areal = ? AND gebaeude = ? AND geschoss = ? AND raumNr = ?",
+        room_key(room),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    store_rooms(conn, [room])
+    return _room_id(conn, room)
+
+
+def has_rooms(conn: sqlite3.Connection) -> bool:
+    """
+    Returns whether the rooms were stored, otherwise stored_rooms fetches them first
+    """
+    return conn.execute("SELECT 1 FROM rooms LIMIT 1").fetchone() is not None
+
+
+def stored_rooms(
+    conn: sqlite3.Connection,
+    buildings: Optional[Iterable[str]] = None,
+    room_filter: Optional[RoomFilter] = None,
+) -> List[Room]:
+    """
+    Returns all stored rooms, optionally only those in the given buildings and accepted by room_filter.
+    Rooms are initially loaded from all_rooms, the infos needed by room_filter are fetched in bulk if missing.
+    """
+    if not has_rooms(conn):
+        store_rooms(conn, all_rooms())
+    buildings = list(buildings) if buildings else None
+    if room_filter:
+        sync_room_infos(conn, stored_rooms(conn, buildings))
+    join, params = _filter_clause(room_filter, "r.id")
+    query = f"SELECT {', '.join('r.' + c for c in ROOM_COLUMNS)} FROM rooms r" + join
+    if buildings:
+        query += f" WHERE r.gebaeude IN ({', '.join('?' * len(buildings))})"
+        params += buildings
+    return [Room(*row) for row in conn.execute(query + " ORDER BY r.id", params)]
+
+
+def store_room_info(conn: sqlite3.Connection, room: Room, info: Dict[str, str]):
+    room_id = _room_id(conn, room)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO room_info VALUES (?, ?, ?)",
+            ((room_id, k, v) for k, v in info.items()),
+        )
+        _store_attributes(conn, room_id, room_attributes(info))
+
+
+def _store_attributes(conn: sqlite3.Connection, room_id: int, attributes: RoomAttributes):
+    # unchanged attributes are not written, such that they keep their version
+    conn.execute(
+        """
+        INSERT INTO room_attributes VALUES (?, ?, ?) ON CONFLICT (room_id) DO UPDATE
+        SET kind = excluded.kind, seats = excluded.seats
+        WHERE kind IS NOT excluded.kind OR seats IS NOT excluded.seats
+        """,
+        (room_id, attributes.kind, attributes.seats),
+    )
+
+
+def missing_room_infos(conn: sqlite3.Connection, rooms: Iterable[Room]) -> List[Room]:
+    """
+    Returns the rooms whose info is not stored
+    """
+    stored = {row[0] for row in conn.execute("SELECT room_id FROM room_attributes")}
+    return [r for r in rooms if _room_id(conn, r) not in stored]
+
+
+def sync_room_infos(conn: sqlite3.Connection, rooms: Iterable[Room], max_workers: int = MAX_WORKERS):
+    """
+    Makes sure that the infos of all rooms are stored, fetching the missing ones concurrently
+    """
+    for room, info in fetch_concurrently(parse_room_info.room_info, missing_room_infos(conn, rooms), max_workers):
+        store_room_info(conn, room, info)
+
+
+def stored_room_info(conn: sqlite3.Connection, room: Room) -> Dict[str, str]:
+    """
+    Returns the stored room info, fetches and stores it if missing
+    """
+    info = dict(
+        conn.execute(
+            "SELECT key, value FROM room_info WHERE room_id = ?", (_room_id(conn, room),)
+        ).fetchall()
+    )
+    if not info:
+        info = parse_room_info.room_info(room)
+        store_room_info(conn, room, info)
+    return info
+
+
+def room_attributes_version(conn: sqlite3.Connection) -> int:
+    """
+    Returns a number that changes whenever room attributes are stored, unlike the database file with every write
+    """
+    row = conn.execute("SELECT version FROM versions WHERE name = 'room_attributes'").fetchone()
+    return row[0] if row is not None else 0
+
+
+def stored_room_attributes(conn: sqlite3.Connection) -> Dict[Tuple[str, ...], RoomAttributes]:
+    """
+    Returns the stored attributes of all rooms, keyed by (region, areal, gebaeude, geschoss, raumNr)
+    """
+    return {
+        tuple(row[:-2]): RoomAttributes(kind=row[-2], seats=row[-1])
+        for row in conn.execute(
+            """
+            SELECT r.region, r.areal, r.gebaeude, r.geschoss, r.raumNr, a.kind, a.seats
+            FROM room_attributes a JOIN rooms r ON r.id = a.room_id
+            """
+        )
+    }
+
+
+def stored_room_infos(conn: sqlite3.Connection) -> Dict[Tuple[str, ...], Dict[str, str]]:
+    """
+    Returns the stored infos of all rooms, keyed by (region, areal, gebaeude, geschoss, raumNr)
+    """
+    infos: Dict[Tuple[str, ...], Dict[str, str]] = {}
+    for *key, info_key, value in conn.execute(
+        """
+        SELECT r.region, r.areal, r.gebaeude, r.geschoss, r.raumNr, i.key, i.value
+        FROM room_info i JOIN rooms r ON r.id = i.room_id
+        """
+    ):
+        infos.setdefault(tuple(key), {})[info_key] = value
+    return infos
+
+
+def store_occupancy(conn: sqlite3.Connection, room: Room, week: CachedRoomOccupancy):
+    """
+    Stores the occupancy of a room for one week, replacing previously stored data of that week
+    """
+    room_id = _room_id(conn, room)
+    begin, end = _ts(week.begin), _ts(week.end)
+    with conn:
+        if week.data:
+            # the first slot of a week starts in the evening before the week
+            conn.execute(
+                "DELETE FROM occupancy WHERE room_id = ? AND begin >= ? AND begin <= ?",
+                (room_id, _ts(min(ts.begin for ts in week.data)), _ts(max(ts.begin for ts in week.data))),
+            )
+        conn.executemany(
+            "INSERT INTO occupancy VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    room_id,
+                    _ts(ts.begin),
+                    _ts(ts.end),
+                    ts.state.name,
+                    ts.event.title if ts.event else None,
+                    ts.event.organization if ts.event else None,
+                )
+                for ts in week.data
+            ),
+        )
+        conn.execute("INSERT OR REPLACE INTO weeks VALUES (?, ?, ?)", (room_id, begin, end))
+
+
+def missing_rooms(conn: sqlite3.Connection, rooms: Iterable[Room], date: date) -> List[Room]:
+    """
+    Returns the rooms for which no occupancy of the week of date is stored
+    """
+    day = _day(date)
+    stored = {
+        row[0]
+        for row in conn.execute(
+            "SELECT room_id FROM weeks WHERE begin <= ? AND ? <= end", (day, day)
+        )
+    }
+    return [r for r in rooms if _room_id(conn, r) not in stored]
+
+
+def sync_occupancy(conn: sqlite3.Connection, rooms: Iterable[Room], date: date):
+    """
+    Makes sure that the occupancy of the week of date is stored for all rooms,
+    fetching the missing rooms concurrently
+    """
+    for room, week in room_occupancy_weeks(missing_rooms(conn, rooms, date), date):
+        store_occupancy(conn, room, week)
+
+
+def stored_occupancies(
+    conn: sqlite3.Connection,
+    date: date,
+    buildings: Optional[Iterable[str]] = None,
+    room_filter: Optional[RoomFilter] = None,
+) -> List[Tuple[Room, List[Timeslot]]]:
+    """
+    Returns the stored timeslots of the week of date of all rooms,
+    optionally only those in the given buildings and accepted by room_filter
+    """
+    day = _day(date)
+    join, params = _filter_clause(room_filter, "w.room_id")
+    # a week contains the slots from sunday 22:00 before the week until sunday 22:00 at its end
+    query = f"""
+        SELECT o.room_id, {', '.join('r.' + c for c in ROOM_COLUMNS)}, o.state, o.begin, o.end, o.title, o.organization
+        FROM weeks w JOIN occupancy o ON o.room_id = w.room_id JOIN rooms r ON r.id = w.room_id{join}
+        WHERE w.begin <= ? AND ? <= w.end AND o.end > w.begin AND o.begin < datetime(w.end, '+22 hours')
+    """
+    params += [day, day]
+    if buildings:
+        buildings = list(buildings)
+        query += f" AND r.gebaeude IN ({', '.join('?' * len(buildings))})"
+        params += buildings
+    result = []
+    last_room_id = None
+    for row in conn.execute(query + " ORDER BY o.room_id, o.begin", params):
+        room, timeslot = _room_timeslot(row)
+        if row[0] != last_room_id:
+            result.append((room, []))
+            last_room_id = row[0]
+        result[-1][1].append(timeslot)
+    return result
+
+
+def _room_timeslot(row: tuple) -> Tuple[Room, Timeslot]:
+    # rows consist of the room id, the room columns and the occupancy columns
+    room = Room(*row[1: len(ROOM_COLUMNS) + 1])
+    state, begin, end, title, organization = row[len(ROOM_COLUMNS) + 1:]
+    return room, Timeslot(
+        state=Occupancy[state],
+        begin=datetime.fromisoformat(begin),
+        end=datetime.fromisoformat(end),
+        event=Class(title, organization) if title is not None else None,
+    )
@@ -0,0 +1,166 @@
+import sqlite3
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from occupancy_grid import (
+    CampusGrid,
+    DAYS,
+    SLOTS_PER_DAY,
+    SLOT,
+    STATES,
+    STATE_CODES,
+    load_campus_grid,
+    slot_index,
+    week_start,
+)
+from parse_occupancy import Room, Occupancy, Timeslot, FREE_STATES
+from parse_room_info import RoomAttributes, RoomFilter
+from free_room import room_key
+from database import stored_room_attributes
+
+
+def stored_attributes(conn: sqlite3.Connection, rooms: Iterable[Room]) -> List[RoomAttributes]:
+    """
+    Returns the attributes of rooms as stored in the database, no kind and 0 seats for rooms without stored info
+    """
+    attributes = stored_room_attributes(conn)
+    return [attributes.get(room_key(r), RoomAttributes()) for r in rooms]
+
+
+class FreeMatrix:
+    """
+    The occupancy of all rooms in one week as (rooms x quarter-hours) matrix,
+    such that campus wide queries are vectorized operations instead of loops over rooms
+    """
+
+    def __init__(
+        self,
+        grid: CampusGrid,
+        seats: Optional[Iterable[int]] = None,
+        states: Set[Occupancy] = FREE_STATES,
+        kinds: Optional[Iterable[Optional[str]]] = None,
+    ):
+        self.week_begin = grid.week_begin
+        self.rooms: List[Room] = grid.rooms
+        self.states = np.frombuffer(grid.states, dtype=np.uint8).reshape(len(self.rooms), DAYS, SLOTS_PER_DAY)
+        self.free_states = frozenset(states)
+        self.free = np.isin(self.states, [STATE_CODES[s] for s in states])
+        # index of the first slot at or after every slot that is not free, per day
+        positions = np.where(self.free, SLOTS_PER_DAY, np.arange(SLOTS_PER_DAY))
+        next_blocked = np.minimum.accumulate(positions[:, :, ::-1], axis=2)[:, :, ::-1]
+        # number of consecutive free slots starting at every slot, runs end at 22:00
+        self.run_lengths = next_blocked - np.arange(SLOTS_PER_DAY)
+        self.buildings, self.building_codes = np.unique([r.gebaeude for r in self.rooms], return_inverse=True)
+        self.seats = np.array(list(seats) if seats is not None else [0] * len(self.rooms), dtype=np.int64)
+        self._indices: Dict[Tuple[str, ...], int] = {room_key(r): i for i, r in enumerate(self.rooms)}
+        self.kinds, self.kind_codes = np.unique(
+            [k or "" for k in kinds] if kinds is not None else [""] * len(self.rooms), return_inverse=True
+        )
+
+    @classmethod
+    def from_occupancies(
+        cls,
+        week_begin: datetime,
+        occupancies: Iterable[Tuple[Room, Iterable[Timeslot]]],
+        seats: Optional[Iterable[int]] = None,
+    ):
+        return cls(CampusGrid.from_occupancies(week_begin, occupancies), seats)
+
+    def _slot(self, t: datetime) -> Optional[Tuple[int, int]]:
+        slot = slot_index(self.week_begin, t)
+        return divmod(slot, SLOTS_PER_DAY) if slot is not None else None
+
+    def state_at(self, t: datetime) -> List[Occupancy]:
+        slot = self._slot(t)
+        if slot is None:
+            return [Occupancy.UNKNOWN] * len(self.rooms)
+        return [STATES[s] for s in self.states[:, slot[0], slot[1]]]
+
+    def free_minutes(self, t: datetime, states: Optional[Set[Occupancy]] = None) -> np.ndarray:
+        """
+        Returns for every room for how many minutes it stays free (or in one of states, if given) starting at t
+        (until 22:00 at most)
+        """
+        slot = self._slot(t)
+        if slot is None:
+            return np.zeros(len(self.rooms))
+        day, s = slot
+        slot_begin = self.week_begin + timedelta(days=day) + timedelta(hours=7) + s * SLOT
+        elapsed = (t - slot_begin) / timedelta(minutes=1)
+        if states is None or frozenset(states) == self.free_states:
+            run_lengths = self.run_lengths[:, day, s]
+        else:
+            # only the rest of the day is looked at, the runs of the free states are precomputed
+            rest = np.isin(self.states[:, day, s:], [STATE_CODES[x] for x in states])
+            run_lengths = np.where(rest.all(axis=1), rest.shape[1], np.argmin(rest, axis=1))
+        runs = run_lengths * (SLOT / timedelta(minutes=1))
+        return np.where(runs > 0, runs - elapsed, 0)
+
+    def free_at(self, t: datetime, states: Optional[Set[Occupancy]] = None) -> np.ndarray:
+        return self.free_minutes(t, states) > 0
+
+    def free_for(self, t: datetime, minutes: float, states: Optional[Set[Occupancy]] = None) -> np.ndarray:
+        return self.free_minutes(t, states) >= max(minutes, 1e-9)
+
+    def in_buildings(self, buildings: Iterable[str]) -> np.ndarray:
+        """
+        Returns the mask of the rooms in one of buildings
+        """
+        return np.isin(self.buildings, list(buildings))[self.building_codes]
+
+    def among(self, rooms: Iterable[Room]) -> np.ndarray:
+        """
+        Returns the mask of rooms, rooms that are not in the matrix are ignored
+        """
+        mask = np.zeros(len(self.rooms), dtype=bool)
+        mask[[i for i in (self._indices.get(room_key(r)) for r in rooms) if i is not None]] = True
+        return mask
+
+    def matching(self, room_filter: Optional[RoomFilter]) -> np.ndarray:
+        """
+        Returns the mask of the rooms accepted by room_filter
+        """
+        if not room_filter:
+            return np.ones(len(self.rooms), dtype=bool)
+        kinds = np.array([room_filter.accepts(RoomAttributes(kind=k, seats=room_filter.min_seats)) for k in self.kinds])
+        return kinds[self.kind_codes] & (self.seats >= room_filter.min_seats)
+
+    def rank(self, mask: np.ndarray, key: np.ndarray, descending: bool = False) -> np.ndarray:
+        """
+        Returns the indices of the rooms selected by mask, sorted by key
+        """
+        indices = np.flatnonzero(mask)
+        order = np.argsort(-key[indices] if descending else key[indices], kind="stable")
+        return indices[order]
+
+    def by_building(self, mask: np.ndarray) -> Dict[str, Tuple[int, int]]:
+        """
+        Aggregates the rooms selected by mask per building into the number of rooms and seats
+        """
+        rooms = np.bincount(self.building_codes, weights=mask, minlength=len(self.buildings))
+        seats = np.bincount(self.building_codes, weights=mask * self.seats, minlength=len(self.buildings))
+        return {
+            str(b): (int(r), int(s)) for b, r, s in zip(self.buildings, rooms, seats) if r > 0
+        }
+
+    def buildings_by_free_seats(self, t: datetime, minutes: float = 0) -> List[Tuple[str, int, int]]:
+        """
+        Returns (building, free rooms, free seats) of all buildings with free rooms at t, most free seats first
+        """
+        aggregated = self.by_building(self.free_for(t, minutes))
+        return sorted(((b, r, s) for b, (r, s) in aggregated.items()), key=lambda x: -x[2])
+
+
+def load_free_matrix(d: date, conn: Optional[sqlite3.Connection] = None) -> Optional[FreeMatrix]:
+    """
+    Loads the matrix of the week of d from the stored campus grid, joined with the stored seat counts if conn is given
+    """
+    grid = load_campus_grid(d)
+    if grid is None or grid.week_begin != week_start(d):
+        return None
+    if conn is None:
+        return FreeMatrix(grid)
+    attributes = stored_attributes(conn, grid.rooms)
+    return FreeMatrix(grid, [a.seats for a in attributes], kinds=[a.kind for a in attributes])
@@ -0,0 +1,47 @@
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Optional, Tuple
+
+from parse_occupancy import Room, Occupancy
+from parse_room_info import RoomAttributes
+
+# orders in which free rooms can be requested, see queries.iter_free_rooms
+ORDERS = ("building", "distance", "seats", "free_until")
+
+
+def room_key(r: Room) -> Tuple[str, ...]:
+    return r.region, r.areal, r.gebaeude, r.geschoss, r.raumNr
+
+
+@dataclass
+class FreeRoom:
+    """
+    A room that is free at the requested time, as answered by the queries and the query server
+    """
+    room: Room
+    state: Occupancy
+    # end of the free time, 22:00 at the latest
+    until: datetime
+    attributes: RoomAttributes
+    # meters from the requested location to the building, if a location was requested
+    distance: Optional[float] = None
+
+    def to_json(self) -> dict:
+        return {
+            "room": asdict(self.room),
+            "state": self.state.name,
+            "until": self.until.isoformat(),
+            "kind": self.attributes.kind,
+            "seats": self.attributes.seats,
+            "distance": self.distance,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "FreeRoom":
+        return cls(
+            room=Room(**data["room"]),
+            state=Occupancy[data["state"]],
+            until=datetime.fromisoformat(data["until"]),
+            attributes=RoomAttributes(kind=data["kind"], seats=data["seats"]),
+            distance=data["distance"],
+        )
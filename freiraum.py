@@ -1,29 +1,160 @@
-from parse_room_list import all_rooms
-from parse_occupancy import room_occupancy, Occupancy
-from datetime import datetime
+from database import DATABASE_PATH, connect, has_rooms, missing_room_infos, missing_rooms, stored_rooms
+from free_room import ORDERS
+from parse_occupancy import Occupancy
+from parse_room_info import RoomFilter
+from snapshot import load_snapshot
+import clock
+from contextlib import closing
+from datetime import date, datetime
 from logging import getLogger, WARNING
-from typing import Iterable
+from typing import Iterable, Optional
 import argparse
+import os
+import sys
 
 __LOGGER__ = getLogger(__file__)
 __LOGGER__.setLevel(WARNING)
 
-def main(buildings: Iterable[str]):
-    rooms = all_rooms()
-    now = datetime.now()
-    for r in rooms:
-        # basic filter for rooms in buildings I am interested in
-        if not buildings or r.gebaeude in buildings:
-            occ = room_occupancy(r)
-            for o in occ:
-                if o.state == Occupancy.FREE and o.begin <= now <= o.end:
-                    print(f"{r.name} is free until {o.end}")
-                    break
-            __LOGGER__.info(f"Checked {r.name}")
+def report(message: str):
+    # on stderr, such that the output only contains the rooms
+    print(message, file=sys.stderr, flush=True)
+
+def main(
+    buildings: Iterable[str],
+    at: Optional[datetime] = None,
+    minutes: int = 0,
+    room_filter: Optional[RoomFilter] = None,
+    order_by: str = "building",
+    limit: Optional[int] = None,
+):
+    at = at or clock.now()
+    # cached answers come from the precompiled snapshot, unless the database changed since it was compiled
+    snapshot = load_snapshot(at.date(), [DATABASE_PATH])
+    cached = snapshot.free_rooms(at, buildings, room_filter, minutes, order_by, limit) if snapshot else None
+    if cached is not None:
+        for r, until in cached:
+            print(f"{r.name} is free until {until}")
+        return
+    # the scraping stack is only imported when the snapshot can not answer
+    from queries import iter_free_rooms
+    from snapshot import store_snapshot
+
+    with closing(connect()) as db:
+        # the snapshot is compiled again if it is missing or outdated, or once something was fetched
+        outdated = snapshot is None
+        if not has_rooms(db):
+            report("Fetching the list of rooms")
+            outdated = True
+        if room_filter:
+            missing = missing_room_infos(db, stored_rooms(db, buildings))
+            if missing:
+                report(f"Fetching the types and seats of {len(missing)} rooms")
+                outdated = True
+        # basic filter for rooms in buildings I am interested in, only their occupancy is fetched
+        rooms = stored_rooms(db, buildings, room_filter)
+        missing = missing_rooms(db, rooms, at.date())
+    if missing:
+        report(
+            f"Fetching the occupancy of {'up to ' if limit else ''}{len(missing)} rooms "
+            f"in {', '.join(sorted({r.gebaeude for r in missing}))}"
+        )
+    __LOGGER__.info(f"Checking {len(rooms)} rooms")
+    # results are printed as soon as they are known, no more rooms are fetched once limit rooms were found
+    for f in iter_free_rooms(
+        rooms, at, order_by, limit, minutes=minutes, states={Occupancy.FREE}, with_attributes=False
+    ):
+        print(f"{f.room.name} is free until {f.until}")
+    if outdated or missing:
+        with closing(connect()) as db:
+            store_snapshot(db, at.date())
+
+def ask_server(
+    server: str,
+    buildings: Iterable[str],
+    at: Optional[datetime] = None,
+    minutes: int = 0,
+    room_filter: Optional[RoomFilter] = None,
+    order_by: str = "building",
+    limit: Optional[int] = None,
+):
+    """
+    Asks a running query server (see query_server.py) instead of the database
+    """
+    from query_client import QueryClient
+
+    at = at or clock.now()
+    rooms = QueryClient(server).free_rooms_in_buildings(
+        set(buildings) or None, at, room_filter, minutes, order_by, limit, {Occupancy.FREE}
+    )
+    for f in rooms:
+        print(f"{f.room.name} is free until {f.until}")
+
+def parse_at(x: str) -> datetime:
+    """
+    Parses a time of today (HH:MM) or of another day (YYYY-MM-DD HH:MM)
+    """
+    try:
+        return datetime.combine(clock.today(), datetime.strptime(x, "%H:%M").time())
+    except ValueError:
+        return datetime.strptime(x, "%Y-%m-%d %H:%M")
+
+def schedule(argv=None):
+    """
+    Prints the occupancy of a room over several days, the weeks in between are fetched concurrently
+    """
+    from parse_occupancy import room_occupancy_range
+
+    parser = argparse.ArgumentParser(prog="freiraum.py schedule", description="Shows the occupancy of a room.")
+    parser.add_argument('building', help='Building of the room, i.e. HG.')
+    parser.add_argument('floor', help='Floor of the room, i.e. E.')
+    parser.add_argument('number', help='Number of the room, i.e. 41.')
+    parser.add_argument('--from', dest='start', type=date.fromisoformat,
+                        help='First day (YYYY-MM-DD) to show, defaults to today.')
+    parser.add_argument('--to', dest='end', type=date.fromisoformat,
+                        help='Last day (YYYY-MM-DD) to show, defaults to the first one.')
+    args = parser.parse_args(argv)
+    start = args.start or clock.today()
+    with closing(connect()) as db:
+        rooms = [
+            r for r in stored_rooms(db, [args.building]) if (r.geschoss, r.raumNr) == (args.floor, args.number)
+        ]
+    if not rooms:
+        report(f"There is no room {args.building} {args.floor} {args.number}")
+        sys.exit(1)
+    for ts in room_occupancy_range(rooms[0], start, args.end or start):
+        event = f" {ts.event.title}" if ts.event is not None else ""
+        print(f"{ts.begin:%a %Y-%m-%d %H:%M} - {ts.end:%H:%M} {ts.state.name.lower()}{event}")
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        import query_server
+        query_server.main(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ['schedule']:
+        schedule(sys.argv[2:])
+        sys.exit()
     parser = argparse.ArgumentParser(description='Finds free rooms in ETHZ buildings.')
     parser.add_argument('buildings', metavar='buildings', type=str, nargs='*',
                         help='Buildings to scan for, omit to scan all.')
+    parser.add_argument('--at', type=parse_at,
+                        help='Time of today (HH:MM) or of another day (YYYY-MM-DD HH:MM) at which the rooms should be free, '
+                             'defaults to now.')
+    parser.add_argument('--minutes', type=int, default=0,
+                        help='Minimum number of minutes the rooms should stay free.')
+    parser.add_argument('--type', dest='kinds', action='append',
+                        help='Part of the room type (Raumtyp), i.e. Seminar or Hörsaal. May be given several times.')
+    parser.add_argument('--min-seats', type=int, default=0,
+                        help='Minimum number of seats (Sitzplätze) of the rooms.')
+    parser.add_argument('--order', dest='order_by', choices=[o for o in ORDERS if o != 'distance'], default='building',
+                        help='Order of the rooms: by building (default), most seats or longest free first.')
+    parser.add_argument('--limit', type=int,
+                        help='Number of rooms to show at most, no more occupancies are fetched once they were found.')
+    parser.add_argument('--server', default=os.environ.get('FREIRAUM_SERVER'),
+                        help='Url of a running query server (python3 freiraum.py serve) to ask instead, '
+                             'defaults to FREIRAUM_SERVER.')
     args = parser.parse_args()
-    main(set(args.buildings))
+    room_filter = RoomFilter(args.kinds, args.min_seats)
+    if args.server:
+        ask_server(args.server, set(args.buildings), args.at, args.minutes, room_filter, args.order_by, args.limit)
+    else:
+        main(set(args.buildings), args.at, args.minutes, room_filter, args.order_by, args.limit)
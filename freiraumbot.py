@@ -1,98 +1,122 @@
 from secrets import TELEGRAM_BOT_TOKEN
 from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters
 import logging
+import os
 import re
-from datetime import datetime, date
-from geopy.distance import geodesic
-from typing import List
-import math
-import textdistance
+from datetime import datetime, timedelta
+from typing import List, Optional
+from threading import Lock
 
-from parse_buildings import all_buildings, Building
-from locate_buildings import all_located_buildings, LocatedBuilding
-from parse_room_list import all_rooms, Room
-from parse_occupancy import room_occupancy, Occupancy
-from parse_room_info import room_info
+from parse_occupancy import Room, Occupancy
+from parse_room_info import RoomFilter, COMMON_KINDS
+from free_room import FreeRoom, room_key
+from query_client import client_from_environment
+from bot_helpers import Coalescer, ReplyStream, coalesced
+import queries
+import metrics
+import clock
 
 
 __LOGGER__ = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                      level=logging.INFO)
 
+# rooms per reply to a location, /more sends the next page
+PAGE_SIZE = 20
+CURSOR_TTL = timedelta(minutes=15)
+# threads running the handlers, such that slow requests do not block the dispatcher
+WORKERS = 8
+# every user has at most one request running
+USER_REQUESTS = Coalescer()
+# "30 Plätze", "≥30 Sitzplätze", "30 seats"
+SEATS_PATTERN = re.compile(r"(\d+)\s*(?:sitz|pl(?:a|ä)tz|seat|pers)", re.IGNORECASE)
+# local port of the prometheus endpoint, and seconds between two summaries in the log
+METRICS_PORT = 9464
+METRICS_LOG_INTERVAL = 10 * 60
+
+# with FREIRAUM_SERVER, the bot is a thin client of the query server (see query_server.py)
+QUERIES = client_from_environment() or queries
+
 occ_str = {
     Occupancy.FREE: "offen",
     Occupancy.CLOSED: "geschlossen",
     Occupancy.UNKNOWN: "vermutlich geschlossen",
 }
 
+
+def parse_room_filter(message: str) -> RoomFilter:
+    """
+    Extracts the wanted room kinds and seats from a message like "Seminarräume mit 30 Plätzen im HG".
+    Words of at least four letters select the known (or common) kinds with a word they abbreviate or inflect.
+    """
+    seats = SEATS_PATTERN.search(message)
+    known_kinds = set(QUERIES.room_kinds()).union(COMMON_KINDS)
+    words = [w for w in re.findall(r"\w+", message.lower()) if len(w) >= 4 and not w.isdigit()]
+    kinds = {
+        kind for kind in known_kinds
+        if any(kind_word_matches(w, part) for w in words for part in re.findall(r"\w+", kind.lower()))
+    }
+    return RoomFilter(kinds=kinds or None, min_seats=int(seats.group(1)) if seats else 0)
+
+
+def kind_word_matches(word: str, part: str) -> bool:
+    # "seminar" and "seminarräume" both mean "seminarraum", "hörsäle" means "hörsaal"
+    return len(os.path.commonprefix([word, part])) >= min(len(word), max(4, len(part) - 3))
+
+
+def describe_room_filter(room_filter: RoomFilter) -> str:
+    parts = sorted(room_filter.kinds or [])
+    if room_filter.min_seats:
+        parts.append(f"ab {room_filter.min_seats} Sitzplätzen")
+    return f" ({', '.join(parts)})" if parts else ""
+
+
 def start(update, context):
     context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="Hi, frag mich nach freien Räumen in deiner Umgebung. Wo soll ich suchen? Sende mir eine Nachricht mit deinem Gebäude oder deinem Standort."
     )
 
+@coalesced(USER_REQUESTS)
+@metrics.timed("handler", handler="room_message")
 def handle_room_message(update, context):
     try:
         message: str = update.message.text
         __LOGGER__.info(f"Received message: {message}")
-        buildings = all_buildings()
-        building_names = {x.name for x in buildings}
+        names = QUERIES.building_names()
+        building_names = names.names
         if message.lower() == "all" or message.lower() == "alle":
             requested_buildings = building_names
         else:
-            requested_buildings = {x.name for x in buildings if re.search(rf"\b{x.name.lower()}\b", message.lower()) is not None}
+            requested_buildings = names.mentions(message)
         if not requested_buildings:
             # detected missspelling if no building was detected
             first_building = message.split()[0].upper()
-            alternatives = []
-            alt_min_dist = math.inf
-            for b in building_names:
-                d = textdistance.levenshtein.distance(b, first_building)
-                if alt_min_dist > d:
-                    alt_min_dist = d
-                    alternatives = [b]
-                elif alt_min_dist == d:
-                    alternatives.append(b)
+            alternatives = names.suggestions(first_building)
             __LOGGER__.info(f"Could not find requested building, suggesting most likely match: {alternatives}")
             context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=f"Ich konnte das Gebäude {first_building} nicht finden, meintest du eines dieser Gebäude: {', '.join(alternatives)}?"
             )
             return
+        room_filter = parse_room_filter(message)
+        if room_filter:
+            __LOGGER__.info(f"Extracted room filter: {room_filter}")
         if requested_buildings != building_names:
             __LOGGER__.info(f"Extracted buildings: {requested_buildings}")
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Okay, suche nach freien Räumen in den Gebäuden {', '.join(requested_buildings)}"
-            )
+            header = f"Okay, suche nach freien Räumen in den Gebäuden {', '.join(requested_buildings)}{describe_room_filter(room_filter)}"
         else:
             __LOGGER__.info(f"Extracted buildings: All buildings")
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Okay, suche nach freien Räumen allen Gebäuden."
-            )
-        rooms = all_rooms()
-        now = datetime.now()
-        count = 0
-        for r in rooms:
-            # basic filter for rooms in buildings I am interested in
-            if not requested_buildings or r.gebaeude in requested_buildings:
-                occ = room_occupancy(r,date=date.today())
-                for o in occ:
-                    if o.state in {Occupancy.FREE, Occupancy.UNKNOWN, Occupancy.CLOSED} and o.begin <= now <= o.end:
-                        r_info = room_info(r)
-                        context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"{r.name} ist frei und {occ_str[o.state]} bis {o.end:%H:%M} Uhr ({r_info['Raumtyp']} mit {r_info['Sitzplätze']} Sitzplätzen)"
-                        )
-                        count += 1
-                        break
-                __LOGGER__.info(f"Checked {r.name}")
-        if count == 0:
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Entschuldige, ich konnte leider keine freien Räume finden."
+            header = f"Okay, suche nach freien Räumen allen Gebäuden{describe_room_filter(room_filter)}."
+        reply = ReplyStream(context.bot, update.effective_chat.id, header)
+        now = clock.now()
+        # basic filter for rooms in buildings I am interested in
+        buildings_filter = requested_buildings if requested_buildings != building_names else None
+        for f in QUERIES.free_rooms_in_buildings(buildings_filter, now, room_filter):
+            reply.add(
+                f"{f.room.name} ist frei und {occ_str[f.state]} bis {f.until:%H:%M} Uhr ({f.attributes.kind} mit {f.attributes.seats} Sitzplätzen)"
             )
+        reply.close(f"Entschuldige, ich konnte leider keine freien Räume finden.")
     except Exception as e:
         context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -102,57 +126,89 @@ def handle_room_message(update, context):
 
 
 
+class ResultCursor:
+    """
+    The position of a location request in the rooms nearest to it, such that /more continues where the last page
+    stopped. Locally the cursor keeps the rooms in distance order and every page resumes the query after the last
+    room looked at, so nothing (like the workers fetching occupancies) is kept alive between pages and no page
+    looks at the rooms of the previous ones again. A query server pages through its free rooms instead.
+    Cursors expire after CURSOR_TTL, as the rooms that are free change over time.
+    """
+
+    def __init__(self, location, now: datetime, rooms: Optional[List[Room]] = None, position: int = 0):
+        self.location = location
+        self.now = now
+        self.expires = now + CURSOR_TTL
+        if rooms is None and QUERIES is queries:
+            rooms = queries.nearest_rooms(location["latitude"], location["longitude"])
+        self.rooms = rooms
+        # index of the first room (or free room of the query server) that was not looked at yet
+        self.position = position
+        self._lock = Lock()
+
+    def expired(self, now: datetime) -> bool:
+        return now >= self.expires
+
+    def renewed(self, now: datetime) -> "ResultCursor":
+        """
+        Returns a fresh cursor for the same location, which continues after the rooms that were already looked at
+        """
+        return ResultCursor(self.location, now, self.rooms, self.position)
+
+    def page(self, size: int) -> List[FreeRoom]:
+        lat, lon = self.location["latitude"], self.location["longitude"]
+        with self._lock:
+            if self.rooms is None:
+                page = list(QUERIES.nearest_free_rooms(lat, lon, self.now, size, offset=self.position))
+                self.position += len(page)
+                return page
+            rooms = self.rooms[self.position:]
+            results = QUERIES.nearest_free_rooms(lat, lon, self.now, size, rooms)
+            try:
+                page = list(results)
+            finally:
+                # shuts down the fetches that are still running before the page is sent
+                results.close()
+            if len(page) < size:
+                self.position = len(self.rooms)
+            else:
+                last = room_key(page[-1].room)
+                self.position += next(i for i, r in enumerate(rooms) if room_key(r) == last) + 1
+            return page
+
+
+@coalesced(USER_REQUESTS)
+@metrics.timed("handler", handler="location")
 def handle_location(update, context):
     try:
         if update.message.location:
             location = update.message.location
             __LOGGER__.info(f"Received location: {location}")
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Okay, suche nach den 20 nächsten freien Räumen."
-            )
-            context.user_data["skip_first"] = 0
-            context.user_data["location"] = location
-            skip_first = 0
+            header = f"Okay, suche nach den {PAGE_SIZE} nächsten freien Räumen."
+            cursor = ResultCursor(location, clock.now())
+            context.chat_data["cursor"] = cursor
         else:
             # otherwise must have been a "more" request
             __LOGGER__.info(f"Received request for more buildings")
-            location = context.user_data["location"]
-            skip_first = context.user_data["skip_first"]
-        buildings: List[LocatedBuilding] = all_located_buildings()
-        building_dist = {b.name: geodesic(
-            (b.lat, b.lon), (location["latitude"], location["longitude"])
-        ).meters for b in buildings}
-        rooms: List[Room] = all_rooms()
-        # order rooms by distance to sent location
-        rooms = sorted(rooms, key=lambda x: building_dist.get(x.gebaeude, math.inf))
-        now = datetime.now()
-        count = 0
-        for r in rooms:
-            # basic filter for rooms in buildings I am interested in
-            occ = room_occupancy(r, date=date.today())
-            for o in occ:
-                if o.state in {Occupancy.FREE, Occupancy.UNKNOWN, Occupancy.CLOSED} and o.begin <= now <= o.end:
-                    if skip_first > 0:
-                        __LOGGER__.info(f"Skipped {r.name}")
-                        skip_first -= 1
-                    else:
-                        r_info = room_info(r)
-                        context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"{r.name} ist frei und {occ_str[o.state]} bis {o.end:%H:%M} Uhr und {int(building_dist[r.gebaeude])}m entfernt ({r_info['Raumtyp']} mit {r_info['Sitzplätze']} Sitzplätzen) "
-                        )
-                        count += 1
-                    break
-            __LOGGER__.info(f"Checked {r.name}")
-            if count >= 20:
-                break
-        if count == 0:
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Entschuldige, ich konnte leider keine freien Räume finden."
+            cursor = context.chat_data.get("cursor")
+            if cursor is None:
+                context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=f"Sende mir zuerst deinen Standort."
+                )
+                return
+            now = clock.now()
+            if cursor.expired(now):
+                # continue with up to date occupancies, but without the rooms that were already sent
+                cursor = cursor.renewed(now)
+                context.chat_data["cursor"] = cursor
+            header = f"Okay, suche nach den {PAGE_SIZE} nächsten weiteren freien Räumen."
+        reply = ReplyStream(context.bot, update.effective_chat.id, header)
+        for f in cursor.page(PAGE_SIZE):
+            reply.add(
+                f"{f.room.name} ist frei und {occ_str[f.state]} bis {f.until:%H:%M} Uhr und {int(f.distance)}m entfernt ({f.attributes.kind} mit {f.attributes.seats} Sitzplätzen)"
             )
-        context.user_data["skip_first"] += count
+        reply.close(f"Entschuldige, ich konnte leider keine freien Räume finden.")
     except Exception as e:
         context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -161,50 +217,36 @@ def handle_location(update, context):
         __LOGGER__.error("Unexpected error occured.", exc_info=e)
 
 
+@metrics.timed("handler", handler="locate")
 def building_location(update, context):
     try:
         message = update.message.text
         __LOGGER__.info(f"Received location request: {message}")
-        buildings: List[Building] = all_buildings()
-        found = False
-        for b in buildings:
-            if b.name.lower() in message.lower().split():
-                __LOGGER__.info(f"found {b}")
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"{b.name}\n{b.street},\n{b.zip} {b.city}",
-                )
-                found = True
-                break
-        if not found:
+        names = QUERIES.building_names()
+        b = next((b for b in map(names.find, message.split()) if b is not None), None)
+        if b is None:
             # detected missspelling if no building was detected
             first_building = message.split()[1].upper()
-            alternatives = []
-            alt_min_dist = math.inf
-            for b in (b.name for b in buildings):
-                d = textdistance.levenshtein.distance(b, first_building)
-                if alt_min_dist > d:
-                    alt_min_dist = d
-                    alternatives = [b]
-                elif alt_min_dist == d:
-                    alternatives.append(b)
+            alternatives = names.suggestions(first_building)
             __LOGGER__.info(f"Could not find requested building, suggesting most likely match: {alternatives}")
             context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=f"Ich konnte das Gebäude {first_building} nicht finden, meintest du eines dieser Gebäude: {', '.join(alternatives)}?"
             )
             return
-        else:
-            located_buildings: List[LocatedBuilding] = all_located_buildings()
-            for lb in located_buildings:
-                if lb.name.lower() in message.split():
-                    __LOGGER__.info(f"found {lb}")
-                    context.bot.send_location(
-                        chat_id=update.effective_chat.id,
-                        latitude=lb.lat,
-                        longitude=lb.lon,
-                    )
-                    return
+        __LOGGER__.info(f"found {b}")
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"{b.name}\n{b.street},\n{b.zip} {b.city}",
+        )
+        lb = QUERIES.located_building(b.name)
+        if lb is not None:
+            __LOGGER__.info(f"found {lb}")
+            context.bot.send_location(
+                chat_id=update.effective_chat.id,
+                latitude=lb.lat,
+                longitude=lb.lon,
+            )
     except Exception as e:
         context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -215,22 +257,29 @@ def building_location(update, context):
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    updater = Updater(token=TELEGRAM_BOT_TOKEN)
+    metrics.serve(METRICS_PORT)
+    metrics.log_periodically(METRICS_LOG_INTERVAL)
+    if QUERIES is queries:
+        # otherwise the query server prefetches
+        clock.watch_days(queries.on_new_day)
+
+    updater = Updater(token=TELEGRAM_BOT_TOKEN, workers=WORKERS)
     dispatcher: Dispatcher = updater.dispatcher
 
-    start_handler = CommandHandler("start", start)
+    # handlers run on the worker threads of the dispatcher, which keeps handling updates of other users meanwhile
+    start_handler = CommandHandler("start", start, run_async=True)
     dispatcher.add_handler(start_handler)
 
-    building_location_handler = CommandHandler("locate", building_location)
+    building_location_handler = CommandHandler("locate", building_location, run_async=True)
     dispatcher.add_handler(building_location_handler)
 
-    more_location_handler = CommandHandler("more", handle_location)
+    more_location_handler = CommandHandler("more", handle_location, run_async=True)
     dispatcher.add_handler(more_location_handler)
 
-    room_handler = MessageHandler(Filters.text & (~Filters.command), handle_room_message)
+    room_handler = MessageHandler(Filters.text & (~Filters.command), handle_room_message, run_async=True)
     dispatcher.add_handler(room_handler)
 
-    location_handler = MessageHandler(Filters.location, handle_location)
+    location_handler = MessageHandler(Filters.location, handle_location, run_async=True)
     dispatcher.add_handler(location_handler)
 
     updater.start_polling()
@@ -0,0 +1,261 @@
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from threading import BoundedSemaphore, Lock
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import REGISTRY
+from response_archive import ARCHIVE_PATH, ResponseArchive, request_key
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# seconds to wait for a connection and for the response
+TIMEOUT = (5, 30)
+# attempts after the first one, waiting BACKOFF * 2 ** attempt seconds in between
+RETRIES = 3
+BACKOFF = 0.5
+# responses that are worth another attempt
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# number of concurrent connections allowed to a single host
+MAX_PER_HOST = 4
+# requests per second (and burst) allowed to a single host
+RATE = 10.0
+BURST = 10
+# number of urls whose validators (ETag, Last-Modified) and last response are remembered
+VALIDATORS = 4096
+
+
+class TokenBucket:
+    """
+    Allows rate acquisitions per second on average and up to capacity at once
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+@dataclass
+class FetchStats:
+    requests: int = 0
+    # requests that failed after all retries
+    failures: int = 0
+    retries: int = 0
+    not_modified: int = 0
+    # seconds spent per attempt, including failed ones
+    attempts: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def record(self, seconds: float):
+        self.attempts += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class HttpClient:
+    """
+    The single HTTP client of all parsers: one pooled session (keep-alive, gzip), timeouts,
+    retries with exponential backoff, a concurrency and rate limit per host, conditional GETs and fetch statistics.
+    With an archive, all successful responses are recorded in it, in replay mode they are served from it
+    and the network is never touched.
+    """
+
+    def __init__(
+        self,
+        pool_maxsize: int = 8,
+        timeout: Tuple[float, float] = TIMEOUT,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        max_per_host: int = MAX_PER_HOST,
+        rate: float = RATE,
+        burst: int = BURST,
+        archive: Optional[ResponseArchive] = None,
+        replay: bool = False,
+    ):
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize))
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.burst = burst
+        self.use_archive(archive, replay)
+        self._lock = Lock()
+        self._host_limits: Dict[str, BoundedSemaphore] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats: Dict[str, FetchStats] = {}
+        # url -> (etag, last modified, text) of the last successful GET
+        self._validators: "OrderedDict[str, Tuple[Optional[str], Optional[str], str]]" = OrderedDict()
+
+    def use_archive(self, archive: Optional[ResponseArchive], replay: bool = False):
+        if replay and archive is None:
+            raise ValueError("Replaying requires an archive")
+        self.archive = archive
+        self.replay = replay
+
+    def _host(self, host: str) -> Tuple[BoundedSemaphore, TokenBucket, FetchStats]:
+        with self._lock:
+            if host not in self._stats:
+                self._host_limits[host] = BoundedSemaphore(self.max_per_host)
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+                self._stats[host] = FetchStats()
+            return self._host_limits[host], self._buckets[host], self._stats[host]
+
+    @contextmanager
+    def host_limit(self, url: str):
+        """
+        Blocks until less than max_per_host requests to the host of url are in flight and the rate allows another one
+        """
+        limit, bucket, _ = self._host(urlparse(url).netloc)
+        with limit:
+            bucket.acquire()
+            yield
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request, retrying connection errors, timeouts and RETRY_STATUS responses with exponential backoff.
+        Raises requests.RequestException once all attempts failed or for error responses.
+        """
+        key = request_key(method, url, kwargs.get("data"))
+        if self.replay:
+            return self.archive.replay(key, url)
+        kwargs.setdefault("timeout", self.timeout)
+        _, _, stats = self._host(urlparse(url).netloc)
+        with self._lock:
+            stats.requests += 1
+        for attempt in range(self.retries + 1):
+            begin = time.monotonic()
+            try:
+                with self.host_limit(url):
+                    response = self.session.request(method, url, **kwargs)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            with self._lock:
+                stats.record(time.monotonic() - begin)
+            if error is None and response.status_code not in RETRY_STATUS:
+                break
+            if attempt < self.retries:
+                with self._lock:
+                    stats.retries += 1
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                __LOGGER__.info(f"{method} {url} failed ({error or response.status_code}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        try:
+            if error is not None:
+                raise error
+            response.raise_for_status()
+        except requests.RequestException:
+            with self._lock:
+                stats.failures += 1
+            raise
+        if self.archive is not None and response.status_code == 200:
+            self.archive.record(key, response)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get_text(self, url: str, **kwargs) -> str:
+        """
+        GETs the text of url, conditionally if it was fetched before and the server sent an ETag or Last-Modified
+        """
+        with self._lock:
+            etag, last_modified, text = self._validators.get(url, (None, None, None))
+        headers = dict(kwargs.pop("headers", {}))
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        response = self.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and text is not None:
+            with self._lock:
+                self._stats[urlparse(url).netloc].not_modified += 1
+                if url in self._validators:
+                    self._validators.move_to_end(url)
+            return text
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag is not None or last_modified is not None:
+            with self._lock:
+                self._validators[url] = (etag, last_modified, response.text)
+                self._validators.move_to_end(url)
+                while len(self._validators) > VALIDATORS:
+                    self._validators.popitem(last=False)
+        return response.text
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the fetch statistics per host
+        """
+        with self._lock:
+            return {
+                host: dict(
+                    asdict(s),
+                    mean_seconds=s.seconds / s.attempts if s.attempts else 0.0,
+                    failure_rate=s.failures / s.requests if s.requests else 0.0,
+                )
+                for host, s in self._stats.items()
+            }
+
+    def log_stats(self):
+        for host, s in self.stats().items():
+            __LOGGER__.info(
+                f"{host}: {s['requests']} requests, {s['failure_rate']:.1%} failed, {s['retries']} retries, "
+                f"{s['not_modified']} not modified, {s['mean_seconds']:.2f}s mean, {s['max_seconds']:.2f}s max"
+            )
+
+
+def client_from_environment() -> HttpClient:
+    """
+    Creates the client configured by the environment:
+    FREIRAUM_ARCHIVE=<directory> records all responses, FREIRAUM_REPLAY=1 replays them (from .cache/archive by default)
+    """
+    archive = os.environ.get("FREIRAUM_ARCHIVE")
+    replay = os.environ.get("FREIRAUM_REPLAY", "") not in ("", "0")
+    if archive or replay:
+        return HttpClient(archive=ResponseArchive(Path(archive) if archive else ARCHIVE_PATH), replay=replay)
+    return HttpClient()
+
+
+CLIENT = client_from_environment()
+
+
+def _client_metrics():
+    for host, stats in CLIENT.stats().items():
+        for name in ("requests", "failures", "retries", "not_modified", "attempts"):
+            yield f"freiraum_http_{name}", {"host": host}, stats[name]
+        yield "freiraum_http_seconds_max", {"host": host}, stats["max_seconds"]
+
+
+REGISTRY.collectors.append(_client_metrics)
@@ -0,0 +1,126 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from parse_occupancy import Room, Occupancy, Timeslot, FREE_STATES
+
+
+class RoomIntervals:
+    """
+    The timeslots of one room in sorted arrays, such that the slot covering a point in time
+    is found by bisection instead of a scan over all timeslots
+    """
+
+    def __init__(self, timeslots: Iterable[Timeslot]):
+        self.timeslots: List[Timeslot] = sorted(timeslots, key=lambda x: x.begin)
+        self.begins: List[datetime] = [t.begin for t in self.timeslots]
+        self.ends: List[datetime] = [t.end for t in self.timeslots]
+        # per set of states, the end of the run of adjacent slots in these states that slot i belongs to
+        self._run_ends: Dict[FrozenSet[Occupancy], List[Optional[datetime]]] = {}
+
+    def _candidates(self, t: datetime) -> range:
+        # the slots that cover t, at most two if t is at the border of two slots
+        i = bisect_right(self.begins, t)
+        return range(max(i - 2, 0), i)
+
+    def slot_at(self, t: datetime, states: Optional[Set[Occupancy]] = None) -> Optional[Timeslot]:
+        """
+        Returns the first slot covering t (and being in one of states, if given)
+        """
+        i = self._index_at(t, states)
+        return self.timeslots[i] if i is not None else None
+
+    def _index_at(self, t: datetime, states: Optional[Set[Occupancy]] = None) -> Optional[int]:
+        for i in self._candidates(t):
+            if self.ends[i] >= t and (states is None or self.timeslots[i].state in states):
+                return i
+        return None
+
+    def state_at(self, t: datetime) -> Occupancy:
+        slot = self.slot_at(t)
+        return slot.state if slot is not None else Occupancy.UNKNOWN
+
+    def run_ends(self, states: Set[Occupancy] = FREE_STATES) -> List[Optional[datetime]]:
+        """
+        For every slot in one of states, the end of the run of adjacent slots in one of states it belongs to
+        """
+        states = frozenset(states)
+        if states not in self._run_ends:
+            run_ends = [None] * len(self.timeslots)
+            for i in reversed(range(len(self.timeslots))):
+                if self.timeslots[i].state not in states:
+                    continue
+                if i + 1 < len(self.timeslots) and run_ends[i + 1] is not None and self.begins[i + 1] == self.ends[i]:
+                    run_ends[i] = run_ends[i + 1]
+                else:
+                    run_ends[i] = self.ends[i]
+            self._run_ends[states] = run_ends
+        return self._run_ends[states]
+
+    def free_until(self, t: datetime, states: Set[Occupancy] = FREE_STATES) -> Optional[datetime]:
+        """
+        Returns until when the room stays in one of states, starting at t, or None if it is not in states at t
+        """
+        i = self._index_at(t, states)
+        return self.run_ends(states)[i] if i is not None else None
+
+    def free_for(self, t: datetime, duration: timedelta, states: Set[Occupancy] = FREE_STATES) -> bool:
+        """
+        Returns whether the room stays in one of states for at least duration, starting at t
+        """
+        until = self.free_until(t, states)
+        return until is not None and until - t >= duration
+
+
+class CampusIndex:
+    """
+    The runs of free slots of all rooms, bucketed by the quarter-hours they cover,
+    such that the rooms free in a time window are found without looking at the timeslots of every room
+    """
+
+    def __init__(
+        self,
+        occupancies: Iterable[Tuple[Room, Iterable[Timeslot]]],
+        states: Set[Occupancy] = FREE_STATES,
+        resolution: timedelta = timedelta(minutes=15),
+    ):
+        self.states = frozenset(states)
+        self.resolution = resolution
+        self.rooms: List[Room] = []
+        self.intervals: List[RoomIntervals] = []
+        # runs of free slots as (begin, end, index of room)
+        self.runs: List[Tuple[datetime, datetime, int]] = []
+        for room, timeslots in occupancies:
+            intervals = RoomIntervals(timeslots)
+            run_ends = intervals.run_ends(self.states)
+            for i, run_end in enumerate(run_ends):
+                # a run starts at a free slot whose predecessor does not belong to the same run
+                if run_end is not None and (i == 0 or run_ends[i - 1] != run_end):
+                    self.runs.append((intervals.begins[i], run_end, len(self.rooms)))
+            self.rooms.append(room)
+            self.intervals.append(intervals)
+        self.origin = min((b for b, _, _ in self.runs), default=datetime.min)
+        self.buckets: Dict[int, List[int]] = {}
+        for run, (begin, end, _) in enumerate(self.runs):
+            for bucket in range(self._bucket(begin), self._bucket(end) + 1):
+                self.buckets.setdefault(bucket, []).append(run)
+
+    def _bucket(self, t: datetime) -> int:
+        return (t - self.origin) // self.resolution
+
+    def free_between(self, begin: datetime, end: datetime) -> List[Tuple[Room, datetime]]:
+        """
+        Returns all rooms that are free during the whole window from begin to end, and until when they are free
+        """
+        result = []
+        for run in self.buckets.get(self._bucket(begin), []):
+            run_begin, run_end, room = self.runs[run]
+            if run_begin <= begin and end <= run_end:
+                result.append((self.rooms[room], run_end))
+        return result
+
+    def free_at(self, t: datetime) -> List[Tuple[Room, datetime]]:
+        return self.free_between(t, t)
+
+    def free_for(self, t: datetime, duration: timedelta) -> List[Tuple[Room, datetime]]:
+        return self.free_between(t, t + duration)
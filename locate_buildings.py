@@ -1,36 +1,104 @@
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from parse_buildings import Building, all_buildings
+from parse_occupancy import fetch_concurrently
 from dataclasses import dataclass, asdict
-import pyphoton
-from cache import cached
+from pathlib import Path
+from urllib.parse import urlencode
+from cache import Cache, argument_key, cache_at, cached
+from http_client import CLIENT
 import logging
+import os
 
 __LOGGER__ = logging.getLogger(__name__)
 
+# photon, or a local stand-in for it
+PHOTON_URL = os.environ.get("FREIRAUM_PHOTON_URL", "https://photon.komoot.io")
+# addresses are located once a year, addresses that were not found are retried after a week
+GEOCODE_CACHE_OPTIONS = dict(ttl=365 * 24 * 60 * 60, maxsize=4096)
+NOT_FOUND_TTL = 7 * 24 * 60 * 60
+# number of addresses located in parallel, the rate per host is limited by the http client
+MAX_WORKERS = 4
+
+# latitude and longitude
+Location = Tuple[float, float]
+# returns the location of an address, None if it was not found
+Geocoder = Callable[[str], Optional[Location]]
+
 
 @dataclass
 class LocatedBuilding(Building):
     lat: float
     lon: float
 
-def locate_buildings(buildings: List[Building]):
-    phclient = pyphoton.Photon(host="https://photon.komoot.io")
+
+def photon_geocode(address: str) -> Optional[Location]:
+    # the query is part of the url, such that archived responses of different addresses are kept apart
+    response = CLIENT.get(f"{PHOTON_URL}/api?{urlencode({'q': address, 'limit': 1})}")
+    features = response.json().get("features")
+    if not features:
+        return None
+    lon, lat = features[0]["geometry"]["coordinates"]
+    return lat, lon
+
+
+def building_address(b: Building) -> str:
+    return f"{b.street}, {b.city}"
+
+
+def geocode_cache(cache=Path(".cache")) -> Cache:
+    return cache_at(Path(cache).joinpath("geocode"), **GEOCODE_CACHE_OPTIONS)
+
+
+def located_address(address: str, geocode: Geocoder = photon_geocode, cache=Path(".cache")) -> Optional[Location]:
+    """
+    Returns the location of an address, stored as soon as it is known such that it is never located twice
+    """
+    return geocode_cache(cache).get(
+        argument_key("geocode", address),
+        lambda: geocode(address),
+        ttl=lambda location: NOT_FOUND_TTL if location is None else GEOCODE_CACHE_OPTIONS["ttl"],
+    )
+
+
+def locate_buildings(
+    buildings: Iterable[Building],
+    geocode: Geocoder = photon_geocode,
+    max_workers: int = MAX_WORKERS,
+) -> List[LocatedBuilding]:
+    """
+    Locates the buildings, every distinct address once and concurrently.
+    Locations are stored per address, so after an interruption only the missing addresses are located again.
+    :param buildings:
+    :param geocode: locates a single address, i.e. a local stand-in for photon
+    :param max_workers: number of addresses located in parallel
+    :return: the buildings that were located, in order
+    """
+    buildings = list(buildings)
+    addresses = list(dict.fromkeys(map(building_address, buildings)))
+
+    def locate(address: str) -> Optional[Location]:
+        try:
+            return located_address(address, geocode)
+        except Exception as e:
+            # not stored, so it is located again on the next run
+            __LOGGER__.warning(f"Failed to locate {address}: {e}")
+            return None
+
+    __LOGGER__.info(f"Locating {len(addresses)} addresses of {len(buildings)} buildings")
+    locations: Dict[str, Optional[Location]] = dict(fetch_concurrently(locate, addresses, max_workers, ordered=False))
     located_buildings = []
     for b in buildings:
-        __LOGGER__.info(f"Locating {b.name}")
-        location = phclient.query(
-            f"{b.street}, {b.city}",
-            limit=1
-        )
-        if location:
-            located_buildings.append(
-                LocatedBuilding(lat=location.latitude, lon=location.longitude, **asdict(b))
-            )
+        location = locations[building_address(b)]
+        if location is not None:
+            lat, lon = location
+            located_buildings.append(LocatedBuilding(lat=lat, lon=lon, **asdict(b)))
         else:
             __LOGGER__.warning(f"Did not find location of {b.name}")
     return located_buildings
 
-@cached("LOCATED_BUILDING_LIST")
+# the addresses are stored one by one, so the list is rebuilt daily: new buildings and addresses that failed
+# (i.e. on a transient error of photon) are located then, all others are answered from the geocode cache
+@cached("LOCATED_BUILDING_LIST", ttl=24 * 60 * 60, stale_while_revalidate=True)
 def all_located_buildings():
     return locate_buildings(all_buildings())
 
@@ -38,4 +106,3 @@ if __name__ == '__main__':
     located_buildings = all_located_buildings()
     for lb in located_buildings:
         print(lb)
-
@@ -0,0 +1,217 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, List, Tuple
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the histogram buckets, from cache hits in memory to slow fetches
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the q-quantile
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Histograms of the duration of stages (fetch, parse, cache, send, ...), counters and gauges, with labels.
+    Rendered in the Prometheus text format or as summary for the log.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        # functions returning additional (name, labels, value) gauges at render time
+        self.collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, object], float]]]] = []
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Times the enclosed block as stage, counting it as in flight meanwhile and as error if it raises
+        """
+        self.add("freiraum_in_flight", 1, stage=stage, **labels)
+        begin = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("freiraum_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("freiraum_stage_seconds", time.perf_counter() - begin, stage=stage, **labels)
+            self.add("freiraum_in_flight", -1, stage=stage, **labels)
+
+    def timed(self, stage: str, **labels):
+        """
+        Decorates a function such that every call is a span
+        """
+        def decorator(func):
+            @wraps(func)
+            def timed_func(*args, **kwargs):
+                with self.span(stage, **labels):
+                    return func(*args, **kwargs)
+
+            return timed_func
+
+        return decorator
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            histograms = {k: (list(h.buckets), list(h.counts), h.count, h.sum) for k, h in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges[(name, _labels(labels))] = value
+        typed = set()
+        for (name, labels), (buckets, counts, count, total) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {kind}")
+                    typed.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """
+        Returns one line per timed stage with count, mean and approximate median and 95th percentile,
+        and the hit rate of every cache
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                if h.count:
+                    lines.append(
+                        f"{dict(labels)}: {h.count}x, {h.sum / h.count * 1000:.1f}ms mean, "
+                        f"p50 <= {h.quantile(0.5) * 1000:g}ms, p95 <= {h.quantile(0.95) * 1000:g}ms"
+                    )
+            caches: Dict[str, Dict[str, float]] = {}
+            for (name, labels), value in self.counters.items():
+                if name == "freiraum_cache_requests_total":
+                    labels = dict(labels)
+                    caches.setdefault(labels["cache"], {})[labels["result"]] = value
+        for cache, results in sorted(caches.items()):
+            total = sum(results.values())
+            lines.append(f"cache {cache}: {results.get('hit', 0) / total:.1%} hits of {int(total)} requests")
+        return lines
+
+    def log_summary(self):
+        for line in self.summary():
+            __LOGGER__.info(line)
+
+
+REGISTRY = Metrics()
+span = REGISTRY.span
+timed = REGISTRY.timed
+
+
+def serve(port: int, host: str = "127.0.0.1"):
+    """
+    Serves the metrics at http://host:port/metrics in the background
+    """
+    # imported here, such that short lived processes like the CLI do not pay for the http server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def log_periodically(interval: float) -> Event:
+    """
+    Logs the summary every interval seconds in the background, until the returned event is set
+    """
+    stopped = Event()
+
+    def log():
+        while not stopped.wait(interval):
+            REGISTRY.log_summary()
+
+    Thread(target=log, name="metrics log", daemon=True).start()
+    return stopped
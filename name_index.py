@@ -0,0 +1,95 @@
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import textdistance
+
+from parse_buildings import Building
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of words under the levenshtein distance, finds the closest words
+    while comparing against only a fraction of all words
+    """
+
+    def __init__(self, words: Iterable[str], distance: Callable[[str, str], int] = textdistance.levenshtein.distance):
+        self.distance = distance
+        # nodes are (word, {distance to word: child node})
+        self.root: Optional[Tuple[str, Dict[int, tuple]]] = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            d = self.distance(word, node[0])
+            if d == 0:
+                return
+            if d not in node[1]:
+                node[1][d] = (word, {})
+                return
+            node = node[1][d]
+
+    def closest(self, word: str) -> List[str]:
+        """
+        Returns all words with the minimal distance to word
+        """
+        if self.root is None:
+            return []
+        best = float("inf")
+        closest = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            d = self.distance(word, node_word)
+            if d < best:
+                best = d
+                closest = [node_word]
+            elif d == best:
+                closest.append(node_word)
+            # by the triangle inequality, only children within best of d can be closer
+            stack.extend(child for k, child in children.items() if d - best <= k <= d + best)
+        return sorted(closest)
+
+
+class BuildingNameIndex:
+    """
+    The names of all buildings, prebuilt once such that mentions in a message are found by a single regex
+    and suggestions for misspelled names by a BK-tree, instead of one pass over all buildings per message
+    """
+
+    def __init__(self, buildings: Iterable[Building]):
+        self.buildings: Dict[str, Building] = {b.name: b for b in buildings}
+        self.names: Set[str] = set(self.buildings)
+        self._lower: Dict[str, str] = {name.lower(): name for name in self.names}
+        # longest names first, such that a name is not shadowed by a shorter name it starts with
+        alternatives = sorted(self._lower, key=len, reverse=True)
+        self._pattern = re.compile(
+            r"\b(?:" + "|".join(map(re.escape, alternatives)) + r")\b" if alternatives else r"(?!)", re.IGNORECASE
+        )
+        self._tree = BKTree(sorted(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def mentions(self, text: str) -> Set[str]:
+        """
+        Returns the names of the buildings mentioned as whole words in text
+        """
+        return {self._lower[m.group(0).lower()] for m in self._pattern.finditer(text)}
+
+    def find(self, word: str) -> Optional[Building]:
+        """
+        Returns the building named word (case insensitive), if there is one
+        """
+        name = self._lower.get(word.lower())
+        return self.buildings[name] if name is not None else None
+
+    def suggestions(self, word: str) -> List[str]:
+        """
+        Returns the names closest to word, i.e. for a misspelled building
+        """
+        return self._tree.closest(word.upper())
@@ -0,0 +1,254 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from dataclasses import asdict
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from free_room import room_key
+from parse_occupancy import Room, Class, Occupancy, Timeslot, columns_to_timeslots
+
+DAYS = 7
+# quarter-hours from 7:00 to 22:00, the part of the day that room_occupancy parses
+SLOTS_PER_DAY = 60
+SLOTS_PER_WEEK = DAYS * SLOTS_PER_DAY
+DAY_BEGIN = timedelta(hours=7)
+SLOT = timedelta(minutes=15)
+
+# occupancies are stored as their index in this list
+STATES: List[Occupancy] = list(Occupancy)
+STATE_CODES: Dict[Occupancy, int] = {s: i for i, s in enumerate(STATES)}
+
+MAGIC = b"FRGRID1\n"
+HEADER = struct.Struct("<I")
+
+
+def week_start(d: date) -> datetime:
+    monday = d - timedelta(days=d.weekday())
+    return datetime(monday.year, monday.month, monday.day)
+
+
+def slot_index(week_begin: datetime, t: datetime) -> Optional[int]:
+    """
+    Returns the index of the quarter-hour of the week covering t, None if t is outside of 7:00 - 22:00
+    """
+    day, offset = divmod(t - week_begin, timedelta(days=1))
+    slot = (offset - DAY_BEGIN) // SLOT
+    if not (0 <= day < DAYS and 0 <= slot < SLOTS_PER_DAY):
+        return None
+    return day * SLOTS_PER_DAY + slot
+
+
+class EventTable:
+    """
+    Interns the events of many rooms, such that every event is stored once and referenced by index.
+    Index 0 is reserved for "no event".
+    """
+
+    def __init__(self, events: Iterable[Optional[Class]] = (None,)):
+        self.events: List[Optional[Class]] = list(events)
+        self.index: Dict[Tuple[str, Optional[str]], int] = {
+            (e.title, e.organization): i for i, e in enumerate(self.events) if e is not None
+        }
+
+    def intern(self, event: Optional[Class]) -> int:
+        if event is None:
+            return 0
+        key = (event.title, event.organization)
+        if key not in self.index:
+            self.index[key] = len(self.events)
+            self.events.append(event)
+        return self.index[key]
+
+    def __getitem__(self, i: int) -> Optional[Class]:
+        return self.events[i]
+
+
+class WeekGrid:
+    """
+    The occupancy of one room in one week as fixed grid of quarter-hours, one state code and event index per slot.
+    The arrays may be views into a shared (memory mapped) buffer.
+    """
+
+    def __init__(self, week_begin: datetime, states, events, event_table: EventTable):
+        self.week_begin = week_begin
+        self.states = states
+        self.events = events
+        self.event_table = event_table
+
+    @classmethod
+    def from_timeslots(cls, week_begin: datetime, timeslots: Iterable[Timeslot], event_table: EventTable):
+        states = bytearray([STATE_CODES[Occupancy.UNKNOWN]] * SLOTS_PER_WEEK)
+        events = array("H", bytes(2 * SLOTS_PER_WEEK))
+        for ts in timeslots:
+            state = STATE_CODES[ts.state]
+            event = event_table.intern(ts.event)
+            # the timeslot covers the slots of the points begin + k * SLOT before its end,
+            # filled per day as ranges instead of point by point (most of a night slot is outside of 7:00 - 22:00)
+            points = -((ts.begin - ts.end) // SLOT)
+            first_day = max((ts.begin - week_begin).days, 0)
+            last_day = min((ts.end - week_begin).days, DAYS - 1)
+            for day in range(first_day, last_day + 1):
+                day_begin = week_begin + timedelta(days=day) + DAY_BEGIN
+                low = max(-((ts.begin - day_begin) // SLOT), 0)
+                high = min(-((ts.begin - day_begin - SLOTS_PER_DAY * SLOT) // SLOT), points)
+                if low >= high:
+                    continue
+                offset = day * SLOTS_PER_DAY + (ts.begin - day_begin) // SLOT
+                states[offset + low:offset + high] = bytes([state]) * (high - low)
+                events[offset + low:offset + high] = array("H", [event]) * (high - low)
+        return cls(week_begin, states, events, event_table)
+
+    def state_at(self, t: datetime) -> Occupancy:
+        slot = slot_index(self.week_begin, t)
+        return STATES[self.states[slot]] if slot is not None else Occupancy.UNKNOWN
+
+    def event_at(self, t: datetime) -> Optional[Class]:
+        slot = slot_index(self.week_begin, t)
+        return self.event_table[self.events[slot]] if slot is not None else None
+
+    def timeslots(self) -> List[Timeslot]:
+        """
+        Returns the occupancy as timeslots, equal to those room_occupancy returns for the week
+        """
+        return columns_to_timeslots(
+            self.week_begin,
+            (
+                [
+                    (self.event_table[self.events[slot]], STATES[self.states[slot]])
+                    for slot in range(day * SLOTS_PER_DAY, (day + 1) * SLOTS_PER_DAY)
+                ]
+                for day in range(DAYS)
+            ),
+        )
+
+
+class CampusGrid:
+    """
+    The week grids of all rooms in two contiguous arrays (rooms x slots) with one shared event table,
+    stored in a single file that is memory mapped on load.
+    meta holds additional (json) data about the rooms that is stored along with the grid.
+    """
+
+    def __init__(
+        self,
+        week_begin: datetime,
+        rooms: List[Room],
+        states,
+        events,
+        event_table: EventTable,
+        meta: Optional[dict] = None,
+    ):
+        self.week_begin = week_begin
+        self.rooms = rooms
+        self.states = states
+        self.events = events
+        self.event_table = event_table
+        self.meta = meta or {}
+        self._room_index = {room_key(r): i for i, r in enumerate(rooms)}
+
+    @classmethod
+    def from_occupancies(
+        cls,
+        week_begin: datetime,
+        occupancies: Iterable[Tuple[Room, Iterable[Timeslot]]],
+        meta: Optional[dict] = None,
+    ):
+        event_table = EventTable()
+        rooms = []
+        states = bytearray()
+        events = array("H")
+        for room, timeslots in occupancies:
+            grid = WeekGrid.from_timeslots(week_begin, timeslots, event_table)
+            rooms.append(room)
+            states += grid.states
+            events += grid.events
+        return cls(week_begin, rooms, states, events, event_table, meta)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def grid(self, i: int) -> WeekGrid:
+        return WeekGrid(
+            self.week_begin,
+            self.states[i * SLOTS_PER_WEEK:(i + 1) * SLOTS_PER_WEEK],
+            self.events[i * SLOTS_PER_WEEK:(i + 1) * SLOTS_PER_WEEK],
+            self.event_table,
+        )
+
+    def room_grid(self, room: Room) -> Optional[WeekGrid]:
+        i = self._room_index.get(room_key(room))
+        return self.grid(i) if i is not None else None
+
+    def occupancies(self) -> Iterator[Tuple[Room, List[Timeslot]]]:
+        """
+        Yields the timeslots of all rooms, computed lazily room by room
+        """
+        for i, room in enumerate(self.rooms):
+            yield room, self.grid(i).timeslots()
+
+    def save(self, path: Path):
+        header = json.dumps({
+            "week_begin": self.week_begin.isoformat(),
+            "byteorder": sys.byteorder,
+            "rooms": [asdict(r) for r in self.rooms],
+            "events": [asdict(e) if e is not None else None for e in self.event_table.events],
+            "meta": self.meta,
+        }).encode()
+        # keep the event array aligned to its item size
+        header += b" " * (-(len(MAGIC) + HEADER.size + len(header) + len(self.states)) % 2)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as grid_file:
+            grid_file.write(MAGIC)
+            grid_file.write(HEADER.pack(len(header)))
+            grid_file.write(header)
+            grid_file.write(self.states)
+            grid_file.write(self.events.tobytes())
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path):
+        with Path(path).open("rb") as grid_file:
+            buffer = mmap.mmap(grid_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a campus grid")
+        offset = len(MAGIC)
+        (header_size,) = HEADER.unpack_from(buffer, offset)
+        offset += HEADER.size
+        header = json.loads(buffer[offset:offset + header_size])
+        offset += header_size
+        rooms = [Room(**r) for r in header["rooms"]]
+        size = len(rooms) * SLOTS_PER_WEEK
+        view = memoryview(buffer)
+        states = view[offset:offset + size]
+        events = view[offset + size:offset + 3 * size].cast("H")
+        if header["byteorder"] != sys.byteorder:
+            events = array("H", events.tobytes())
+            events.byteswap()
+        return cls(
+            datetime.fromisoformat(header["week_begin"]),
+            rooms,
+            states,
+            events,
+            EventTable(Class(**e) if e is not None else None for e in header["events"]),
+            header.get("meta"),
+        )
+
+
+def campus_grid_path(d: date, cache=Path(".cache")) -> Path:
+    return cache.joinpath(f"campus_{week_start(d):%Y-%m-%d}.grid")
+
+
+def load_campus_grid(d: date, cache=Path(".cache")) -> Optional[CampusGrid]:
+    """
+    Loads the campus grid of the week of d, if one was stored
+    """
+    try:
+        return CampusGrid.load(campus_grid_path(d, cache))
+    except FileNotFoundError:
+        return None
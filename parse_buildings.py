@@ -1,6 +1,4 @@
 from dataclasses import dataclass
-import requests
-from bs4 import BeautifulSoup
 from cache import cached
 
 BUILDINGS_URL = "https://ethz.ch/services/en/service/rooms-and-buildings/building-orientation.html?_charset_=UTF-8&geb=&str=&zip=&city="
@@ -12,12 +10,13 @@ class Building:
     zip: str
     city: str
 
-@cached("BUILDING_LIST")
+@cached("BUILDING_LIST", ttl=7 * 24 * 60 * 60, stale_while_revalidate=True)
 def all_buildings():
+    # the scraping stack is only imported once the buildings are actually fetched
+    from bs4 import BeautifulSoup
+    from http_client import CLIENT
 
-    r1 = requests.get(BUILDINGS_URL, headers={"User-Agent": "Spoof"})
-
-    site = r1.text
+    site = CLIENT.get_text(BUILDINGS_URL, headers={"User-Agent": "Spoof"})
     soup = BeautifulSoup(site, features="lxml")
     table = soup.find(name="table", attrs={"class":"result donthyphenate"})
     buildings = []
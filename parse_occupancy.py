@@ -1,15 +1,41 @@
-import requests
 from dataclasses import dataclass, asdict
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Iterable, Iterator, Callable, TypeVar, TYPE_CHECKING
 from enum import Enum
 from datetime import timedelta, date, datetime
 import re
-from bs4 import BeautifulSoup
-from itertools import product
+from itertools import product, islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
 
-import pickle
 from pathlib import Path
+from cache import Cache, SingleFlight, cache_at
+from metrics import timed
+import clock
 
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+# rauminfo, or a stand-in for it like the one of benchmark.py
+RAUMINFO_URL = os.environ.get("FREIRAUM_RAUMINFO_URL", "http://www.rauminfo.ethz.ch")
+OCCUPANCY_URL = f"{RAUMINFO_URL}/Rauminfo/Rauminfo.do"
+
+WEEK_PATTERN = re.compile(
+    r"(?P<week_begin>\d\d\.\d\d\.\d\d\d\d)&nbsp;bis&nbsp;(?P<week_end>\d\d\.\d\d\.\d\d\d\d)"
+)
+
+# occupancies are refetched daily, at most ~200MB are kept on disk
+# (several weeks per room, past weeks no longer change and are kept until evicted)
+OCCUPANCY_CACHE_OPTIONS = dict(ttl=24 * 60 * 60, maxsize=4096, max_bytes=200 * 2 ** 20)
+
+# number of rooms fetched in parallel by room_occupancies
+MAX_WORKERS = 8
+T = TypeVar("T")
+R = TypeVar("R")
+_DONE = object()
+
+# concurrent fetches of the same room and week share one request
+_FETCHES = SingleFlight()
 
 def table_to_2d(table_tag, value_f=lambda x: x.get_text()):
     """
@@ -17,13 +43,22 @@ def table_to_2d(table_tag, value_f=lambda x: x.get_text()):
     the result of passing the td tag to value_f
     > adjusted from https://stackoverflow.com/questions/48393253/how-to-parse-table-with-rowspan-and-colspan
     """
+    return _rows_to_2d(
+        table_tag.find_all("tr"), lambda row: row.find_all(["td", "th"], recursive=False), value_f
+    )
+
+
+def _rows_to_2d(rows, cells_of, value_f):
+    """
+    The row and colspan resolution of table_to_2d, for rows whose td and th cells are returned by cells_of
+    """
     rowspans = []  # track pending rowspans
-    rows = table_tag.find_all("tr")
+    rows = list(rows)
 
     # first scan, see how many columns we need
     colcount = 0
     for r, row in enumerate(rows):
-        cells = row.find_all(["td", "th"], recursive=False)
+        cells = cells_of(row)
         # count columns (including spanned).
         # add active rowspans from preceding rows
         # we *ignore* the colspan value on the last cell, to prevent
@@ -50,7 +85,7 @@ def table_to_2d(table_tag, value_f=lambda x: x.get_text()):
     rowspans = {}  # track pending rowspans, column number mapping to count
     for row, row_elem in enumerate(rows):
         span_offset = 0  # how many columns are skipped due to row and colspans
-        for col, cell in enumerate(row_elem.find_all(["td", "th"], recursive=False)):
+        for col, cell in enumerate(cells_of(row_elem)):
             # adjust for preceding row and colspans
             col += span_offset
             while rowspans.get(col, 0):
@@ -119,6 +154,10 @@ class Occupancy(Enum):
     INVALID = "#eeeeee"
 
 
+# states in which a room can be used for studying
+FREE_STATES = {Occupancy.FREE, Occupancy.UNKNOWN, Occupancy.CLOSED}
+
+
 @dataclass
 class Timeslot:
     state: Occupancy
@@ -127,7 +166,7 @@ class Timeslot:
     event: Optional[Class] = None
 
 
-def parse_td(x: BeautifulSoup) -> (Optional[Class], Occupancy):
+def parse_td(x: "BeautifulSoup") -> (Optional[Class], Occupancy):
     # if the background color is invalid, the whole cell is part of the "frame"
     if not x.attrs["bgcolor"].startswith("#"):
         return (None, Occupancy.INVALID)
@@ -147,6 +186,43 @@ def parse_td(x: BeautifulSoup) -> (Optional[Class], Occupancy):
         return (Class(title, organization), occupancy)
 
 
+def table_to_2d_lxml(table_element, value_f=lambda x: x.text_content()):
+    """
+    Like table_to_2d, but works on an lxml element
+    """
+    return _rows_to_2d(
+        table_element.iter("tr"), lambda row: [cell for cell in row if cell.tag in ("td", "th")], value_f
+    )
+
+
+def parse_td_lxml(x) -> (Optional[Class], Occupancy):
+    """
+    Like parse_td, but for cells of an lxml tree
+    """
+    bgcolor = x.get("bgcolor")
+    # if the background color is invalid, the whole cell is part of the "frame"
+    if not bgcolor.startswith("#"):
+        return (None, Occupancy.INVALID)
+    # otherwise it encodes the occupancy
+    occupancy = Occupancy(bgcolor)
+
+    # is there a title for this class?
+    title = next(x.iterfind('.//*[@color="#ffffff"]'), None)
+    if title is None:
+        # if not, the room is empty/closed/cell invalid
+        return (None, occupancy)
+    else:
+        # otherwise find title and potentially organisation of class
+        organization = next(x.iterfind('.//*[@color="#dddddd"]'), None)
+        return (
+            Class(
+                title.text_content().strip(),
+                organization.text_content().strip() if organization is not None else None,
+            ),
+            occupancy,
+        )
+
+
 def transpose(l):
     return list(map(list, zip(*l)))
 
@@ -163,22 +239,97 @@ class CachedRoomOccupancy:
     data: List[Timeslot]
 
 
-def room_occupancy(room: Room, date: date = date.today(), cache=Path(".cache")):
+def room_occupancy(room: Room, date: Optional[date] = None, cache=Path(".cache")):
     """
     For a room and date fetches and returns the occupancy of a room in the week of the date
     :param room:
-    :param date:
+    :param date: defaults to today
     :param cache:
     :return:
     """
-    if cache:
-        try:
-            with cache.joinpath("".join(map(str, asdict(room).values()))).open("rb") as room_cache_file:
-                rcf: CachedRoomOccupancy = pickle.load(room_cache_file)
-                if rcf.begin <= datetime(date.year, date.month, date.day) <= rcf.end:
-                    return rcf.data
-        except (FileNotFoundError, EOFError):
-            pass
+    return room_occupancy_week(room, date, cache).data
+
+
+def room_occupancy_week(room: Room, date: Optional[date] = None, cache=Path(".cache")) -> CachedRoomOccupancy:
+    """
+    Like room_occupancy, but also returns the bounds of the week that was fetched
+    :param room:
+    :param date: defaults to today
+    :param cache:
+    :return:
+    """
+    date = date or clock.today()
+    if not cache:
+        return parse_occupancy_page(fetch_occupancy_page(room, date))
+    return occupancy_cache(cache).get(
+        occupancy_key(room, date),
+        lambda: parse_occupancy_page(fetch_occupancy_page(room, date)),
+        valid=lambda rcf: rcf.begin <= datetime(date.year, date.month, date.day) <= rcf.end,
+        ttl=week_ttl,
+    )
+
+
+def week_ttl(rcf: CachedRoomOccupancy) -> Optional[float]:
+    """
+    Returns how long the cached week stays valid: weeks that are over never change again
+    """
+    if rcf.end.date() < clock.today():
+        return None
+    return OCCUPANCY_CACHE_OPTIONS["ttl"]
+
+
+def room_occupancy_range(
+    room: Room,
+    start: date,
+    end: date,
+    cache=Path(".cache"),
+    max_workers: int = MAX_WORKERS,
+) -> List[Timeslot]:
+    """
+    Returns the occupancy of a room from the beginning of start to the end of end as one timeline.
+    The weeks in between are cached separately, missing ones are fetched concurrently.
+    :param room:
+    :param start: first day of the range
+    :param end: last day of the range (inclusive)
+    :param cache:
+    :param max_workers: number of weeks fetched in parallel
+    :return: the timeslots overlapping the range, in order
+    """
+    mondays = []
+    monday = start - timedelta(days=start.weekday())
+    while monday <= end:
+        mondays.append(monday)
+        monday += timedelta(weeks=1)
+    begin = datetime(start.year, start.month, start.day)
+    until = datetime(end.year, end.month, end.day) + timedelta(days=1)
+    timeline = []
+    for _, rcf in fetch_concurrently(
+        lambda monday: room_occupancy_week(room, monday, cache), mondays, min(max_workers, len(mondays) or 1)
+    ):
+        # consecutive weeks join seamlessly, the night before every day is part of that day
+        timeline.extend(ts for ts in rcf.data if ts.begin < until and ts.end > begin)
+    return timeline
+
+
+def occupancy_cache(cache=Path(".cache")) -> Cache:
+    return cache_at(Path(cache).joinpath("occupancy"), **OCCUPANCY_CACHE_OPTIONS)
+
+
+def occupancy_key(room: Room, date: date) -> str:
+    # one entry per room and week, weeks start on monday
+    monday = date - timedelta(days=date.weekday())
+    return "".join(map(str, asdict(room).values())) + f"_{monday:%Y-%m-%d}"
+
+
+def fetch_occupancy_page(room: Room, date: date) -> str:
+    """
+    Fetches the raw occupancy page of a room in the week of the date
+    """
+    return _FETCHES.do(occupancy_key(room, date), lambda: _fetch_occupancy_page(room, date))
+
+
+@timed("fetch", source="occupancy")
+def _fetch_occupancy_page(room: Room, date: date) -> str:
     post_data = {
         "tag": str(date.day),
         "monat": MONTH_TO_DAY.get(date.month, "Unk"),
@@ -186,37 +337,76 @@ def room_occupancy(room: Room, date: date = date.today(), cache=Path(".cache")):
         "checkUsage": "anzeigen",
         **asdict(room),
     }
+    # the scraping stack is only imported once something is actually fetched or parsed
+    from http_client import CLIENT
+
     # fetch room occupancy
-    r = requests.post(
-        "http://www.rauminfo.ethz.ch/Rauminfo/Rauminfo.do", data=post_data
-    )
-    site = r.text
-    #print(site, file=open("room_occupancy.html", "w"))
+    return CLIENT.post(OCCUPANCY_URL, data=post_data).text
+
+
+def occupancy_table_bs4(site: str) -> List[List[Tuple[Optional[Class], Occupancy]]]:
+    """
+    Parses the occupancy table of a raw occupancy page using BeautifulSoup
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(site, features="lxml")
+    tables = soup.find_all("table")
+    occupancy_table = tables[1]
+    return table_to_2d(occupancy_table, parse_td)
+
+
+def occupancy_table_lxml(site: str) -> List[List[Tuple[Optional[Class], Occupancy]]]:
+    """
+    Parses the occupancy table of a raw occupancy page directly on the lxml tree,
+    equivalent to but much faster than occupancy_table_bs4
+    """
+    import lxml.html
+
+    document = lxml.html.document_fromstring(site)
+    occupancy_table = next(islice(document.iter("table"), 1, None))
+    return table_to_2d_lxml(occupancy_table, parse_td_lxml)
+
+
+@timed("parse", source="occupancy")
+def parse_occupancy_page(site: str, parse_table=occupancy_table_lxml) -> CachedRoomOccupancy:
+    """
+    Parses a raw occupancy page into the timeslots of the week it shows
+    :param site:
+    :param parse_table: function extracting the occupancy table of the page as 2D matrix
+    :return:
+    """
     # extract the actual start of the week
-    match = next(
-        iter(
-            re.finditer(
-                r"(?P<week_begin>\d\d\.\d\d\.\d\d\d\d)&nbsp;bis&nbsp;(?P<week_end>\d\d\.\d\d\.\d\d\d\d)",
-                site,
-            )
-        )
-    )
+    match = WEEK_PATTERN.search(site)
     week_begin = parse_date(match.group("week_begin"))
     week_end = parse_date(match.group("week_end"))
 
     # parse the occupancy table
-    soup = BeautifulSoup(site, features="lxml")
-    tables = soup.find_all("table")
-    occupancy_table = tables[1]
-    room_occupancy = table_to_2d(occupancy_table, parse_td)
+    room_occupancy = parse_table(site)
 
     # the occupancy table has one row frame and tow cols frame (on the left)
     # the remainder is one slot per course, resolved in quarter-hours
     room_occupancy: List[List[Tuple[Optional[Class], Occupancy]]] = transpose(
         room_occupancy
     )
+    return CachedRoomOccupancy(
+        week_begin,
+        week_end,
+        columns_to_timeslots(week_begin, [col[1:] for col in room_occupancy[2:]])
+    )
+
+
+def columns_to_timeslots(
+    week_begin: datetime, columns: Iterable[Iterable[Tuple[Optional[Class], Occupancy]]]
+) -> List[Timeslot]:
+    """
+    Merges the quarter-hours of every day (from 7:00 to 22:00) into timeslots of the same event and state
+    :param week_begin:
+    :param columns: one column per day with the event and state of every quarter-hour
+    :return:
+    """
     timeslots = []
-    for colc, col in enumerate(room_occupancy[2:]):
+    for colc, col in enumerate(columns):
         cur_start_day = week_begin + timedelta(days=colc)
         # there is an unknown filling from the day before 22:00 to 7:00
         cur_event = Timeslot(
@@ -224,7 +414,7 @@ def room_occupancy(room: Room, date: date = date.today(), cache=Path(".cache")):
             begin=cur_start_day - timedelta(hours=2),
             end=cur_start_day + timedelta(hours=7),
         )
-        for rowc, row in enumerate(col[1:]):
+        for rowc, row in enumerate(col):
             if not (cur_event.event == row[0] and cur_event.state == row[1]):
                 cur_start_time_minutes = (
                         cur_start_day + timedelta(hours=7) + rowc * timedelta(minutes=15)
@@ -240,19 +430,106 @@ def room_occupancy(room: Room, date: date = date.today(), cache=Path(".cache")):
         # last event ends at 22:==
         cur_event.end = cur_start_day + timedelta(hours=22)
         timeslots.append(cur_event)
-    if cache:
-        cache.mkdir(parents=True, exist_ok=True)
-        with cache.joinpath("".join(map(str, asdict(room).values()))).open("wb") as room_cache_file:
-            rcf = CachedRoomOccupancy(
-                week_begin,
-                week_end,
-                timeslots
-            )
-            pickle.dump(rcf, room_cache_file)
     return timeslots
 
 
+def store_room_occupancy(room: Room, rcf: CachedRoomOccupancy, cache=Path(".cache")):
+    occupancy_cache(cache).store(occupancy_key(room, rcf.begin), rcf)
+
+
+def room_occupancies(
+    rooms: Iterable[Room],
+    date: Optional[date] = None,
+    cache=Path(".cache"),
+    max_workers: int = MAX_WORKERS,
+    ordered: bool = True,
+) -> Iterator[Tuple[Room, List[Timeslot]]]:
+    """
+    Fetches the occupancy of many rooms concurrently, see room_occupancy.
+    At most 2 * max_workers rooms are in flight at once, so stopping the iteration early
+    (i.e. after enough free rooms were found) does not fetch the remaining rooms.
+    :param rooms:
+    :param date: defaults to today
+    :param cache:
+    :param max_workers: size of the worker pool
+    :param ordered: yield results in the order of rooms, otherwise as soon as they complete
+    :return: pairs of room and its occupancy
+    """
+    for room, rcf in room_occupancy_weeks(rooms, date, cache, max_workers, ordered):
+        yield room, rcf.data
+
+
+def room_occupancy_weeks(
+    rooms: Iterable[Room],
+    date: Optional[date] = None,
+    cache=Path(".cache"),
+    max_workers: int = MAX_WORKERS,
+    ordered: bool = True,
+) -> Iterator[Tuple[Room, CachedRoomOccupancy]]:
+    """
+    Like room_occupancies, but also returns the bounds of the weeks that were fetched
+    """
+    # evaluated once, such that all rooms are fetched for the same week even around midnight
+    date = date or clock.today()
+    yield from fetch_concurrently(
+        lambda room: room_occupancy_week(room, date, cache), rooms, max_workers, ordered
+    )
+
+
+def fetch_concurrently(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    max_workers: int = MAX_WORKERS,
+    ordered: bool = True,
+) -> Iterator[Tuple[T, R]]:
+    """
+    Applies func to all items on a bounded worker pool.
+    At most 2 * max_workers items are in flight at once, so stopping the iteration early
+    does not process the remaining items.
+    :param func:
+    :param items:
+    :param max_workers: size of the worker pool
+    :param ordered: yield results in the order of items, otherwise as soon as they complete
+    :return: pairs of item and result
+    """
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit_next():
+            item = next(items, _DONE)
+            if item is _DONE:
+                return False
+            pending.append((item, executor.submit(func, item)))
+            return True
+
+        try:
+            while len(pending) < 2 * max_workers and submit_next():
+                pass
+            while pending:
+                if ordered:
+                    item, future = pending.popleft()
+                else:
+                    wait([f for _, f in pending], return_when=FIRST_COMPLETED)
+                    item, future = next(p for p in pending if p[1].done())
+                    pending.remove((item, future))
+                submit_next()
+                yield item, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:]:
+        # validate the lxml parser against the BeautifulSoup parser on recorded pages
+        for path in sys.argv[1:]:
+            site = Path(path).read_text()
+            same = parse_occupancy_page(site) == parse_occupancy_page(site, occupancy_table_bs4)
+            print(f"{path}: {'OK' if same else 'MISMATCH'}")
+        sys.exit()
     ro = room_occupancy(
         Room(
             region="Z",
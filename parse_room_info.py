@@ -1,31 +1,106 @@
-import requests
-from bs4 import BeautifulSoup
-from parse_occupancy import Room
+from parse_occupancy import Room, RAUMINFO_URL
 from dataclasses import dataclass, asdict
-from typing import Dict
-import pickle
+from typing import Dict, Iterable, Optional
 from pathlib import Path
+from cache import Cache, SingleFlight, cache_at
+from metrics import timed
 
-ROOM_URL = "http://www.rauminfo.ethz.ch/RauminfoPre.do?region={}&areal={}&gebaeude={}&geschoss={}&raumNr={}"
-
-
-def room_info(room: Room, cache=Path(".cache")) -> Dict[str, str]:
-    if cache:
-        try:
-            with cache.joinpath(
-                "".join(map(str, asdict(room).values())) + "_info"
-            ).open("rb") as room_cache_file:
-                rcf: Dict[str, str] = pickle.load(room_cache_file)
-                return rcf
-        except (FileNotFoundError, EOFError):
-            pass
-    r1 = requests.get(
-        ROOM_URL.format(
-            room.region, room.areal, room.gebaeude, room.geschoss, room.raumNr
-        )
+ROOM_URL = RAUMINFO_URL + "/RauminfoPre.do?region={}&areal={}&gebaeude={}&geschoss={}&raumNr={}"
+
+# concurrent fetches of the same room share one request
+_FETCHES = SingleFlight()
+# keys of the room info that are parsed into RoomAttributes
+KIND_KEY = "Raumtyp"
+SEATS_KEY = "Sitzplätze"
+# common values of KIND_KEY, to recognize kinds before any room info is stored
+COMMON_KINDS = (
+    "Seminarraum",
+    "Hörsaal",
+    "Übungsraum",
+    "Computerarbeitsraum",
+    "Zeichensaal",
+    "Besprechungsraum",
+    "Lernraum",
+)
+
+
+@dataclass
+class RoomAttributes:
+    # i.e. "Seminarraum" or "Hörsaal"
+    kind: Optional[str] = None
+    seats: int = 0
+
+
+@dataclass
+class RoomFilter:
+    """
+    Selects rooms by their attributes, before their occupancy is fetched
+    """
+    # parts of the accepted kinds (case insensitive), any kind if None
+    kinds: Optional[Iterable[str]] = None
+    min_seats: int = 0
+
+    def __bool__(self):
+        return bool(self.kinds) or self.min_seats > 0
+
+    def accepts(self, attributes: RoomAttributes) -> bool:
+        if attributes.seats < self.min_seats:
+            return False
+        if not self.kinds:
+            return True
+        kind = (attributes.kind or "").lower()
+        return any(k.lower() in kind for k in self.kinds)
+
+
+def parse_seats(value: Optional[str]) -> int:
+    """
+    Parses the "Sitzplätze" of a room info, 0 if unknown
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def room_attributes(info: Dict[str, str]) -> RoomAttributes:
+    return RoomAttributes(kind=info.get(KIND_KEY) or None, seats=parse_seats(info.get(SEATS_KEY)))
+
+
+def room_info(room: Room, cache=Path(".cache"), refresh: bool = False) -> Dict[str, str]:
+    if not cache:
+        return parse_room_info_page(fetch_room_info_page(room))
+    return room_info_cache(cache).get(
+        room_info_key(room), lambda: parse_room_info_page(fetch_room_info_page(room)), refresh=refresh
     )
 
-    site = r1.text
+
+def room_info_cache(cache=Path(".cache")) -> Cache:
+    # room infos hardly ever change
+    return cache_at(Path(cache).joinpath("info"), ttl=30 * 24 * 60 * 60, maxsize=4096)
+
+
+def room_info_key(room: Room) -> str:
+    return "".join(map(str, asdict(room).values()))
+
+
+def fetch_room_info_page(room: Room) -> str:
+    return _FETCHES.do(room_info_key(room), lambda: _fetch_room_info_page(room))
+
+
+@timed("fetch", source="room_info")
+def _fetch_room_info_page(room: Room) -> str:
+    from http_client import CLIENT
+
+    url = ROOM_URL.format(
+        room.region, room.areal, room.gebaeude, room.geschoss, room.raumNr
+    )
+    return CLIENT.get_text(url)
+
+
+@timed("parse", source="room_info")
+def parse_room_info_page(site: str) -> Dict[str, str]:
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(site, features="lxml")
     table = soup.find_all("table")[-1]
     specs = {}
@@ -33,14 +108,12 @@ def room_info(room: Room, cache=Path(".cache")) -> Dict[str, str]:
         spec_name = row.find_all("td")[0].find("b").text.strip()
         spec_val = row.find_all("td")[2].text.strip()
         specs[spec_name] = spec_val
-    if cache:
-        cache.mkdir(parents=True, exist_ok=True)
-        with cache.joinpath("".join(map(str, asdict(room).values())) + "_info").open(
-            "wb"
-        ) as room_cache_file:
-            pickle.dump(specs, room_cache_file)
     return specs
 
 
+def store_room_info(room: Room, specs: Dict[str, str], cache=Path(".cache")):
+    room_info_cache(cache).store(room_info_key(room), specs)
+
+
 if __name__ == "__main__":
     print(room_info(Room("Z", "Z", "CAB", "G", "11")))
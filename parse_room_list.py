@@ -1,16 +1,25 @@
 from urllib.parse import urlparse, parse_qs
-import requests
-from bs4 import BeautifulSoup
-from parse_occupancy import Room
-from cache import cached
+from parse_occupancy import Room, RAUMINFO_URL
+from cache import SingleFlight, cached
 
-ROOM_LIST_URL = "http://www.rauminfo.ethz.ch/Rauminfo/Index.do?hidden=&gebaeude=-&showAll=alle+R%C3%A4ume+anzeigen&geschoss=-&leitzahl=-"
+ROOM_LIST_URL = RAUMINFO_URL + "/Rauminfo/Index.do?hidden=&gebaeude=-&showAll=alle+R%C3%A4ume+anzeigen&geschoss=-&leitzahl=-"
 
-@cached("ROOM_LIST")
+# concurrent fetches of the room list share one request
+_FETCHES = SingleFlight()
+
+
+def fetch_room_list_page() -> str:
+    # the scraping stack is only imported once the room list is actually fetched
+    from http_client import CLIENT
+
+    return _FETCHES.do(ROOM_LIST_URL, lambda: CLIENT.get_text(ROOM_LIST_URL))
+
+
+@cached("ROOM_LIST", ttl=24 * 60 * 60, stale_while_revalidate=True)
 def all_rooms():
-    r1 = requests.get(ROOM_LIST_URL)
+    from bs4 import BeautifulSoup
 
-    site = r1.text
+    site = fetch_room_list_page()
     soup = BeautifulSoup(site, features="lxml")
     table = soup.find_all("table")[5]
     rooms = []
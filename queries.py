@@ -0,0 +1,356 @@
+"""
+The free room queries shared by the bot, the query server and the CLI,
+answered from datasets that are kept warm in memory.
+"""
+import heapq
+import logging
+from collections import defaultdict
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from parse_buildings import all_buildings
+from locate_buildings import LocatedBuilding, all_located_buildings
+from parse_occupancy import (
+    Room,
+    Occupancy,
+    Timeslot,
+    CachedRoomOccupancy,
+    FREE_STATES,
+    MAX_WORKERS,
+    room_occupancy_week,
+    fetch_concurrently,
+)
+from parse_room_info import RoomAttributes, RoomFilter, room_attributes, room_info
+from database import (
+    connect,
+    room_attributes_version,
+    stored_rooms,
+    stored_room_info,
+    stored_room_attributes,
+    stored_occupancies,
+    store_occupancy,
+    store_room_info,
+    sync_occupancy,
+    sync_room_infos,
+)
+from crawler import store_campus_grid
+from free_matrix import FreeMatrix, load_free_matrix
+from free_room import FreeRoom, ORDERS, room_key
+from interval_index import RoomIntervals
+from occupancy_grid import DAY_BEGIN, SLOT, SLOTS_PER_DAY, campus_grid_path, week_start
+from resident import Resident, file_generation, cached_file_generation, reread_cached_file
+from spatial_index import BuildingIndex
+from name_index import BuildingNameIndex
+import clock
+
+__LOGGER__ = logging.getLogger(__name__)
+
+
+def load_current_free_matrix() -> Optional[FreeMatrix]:
+    with closing(connect()) as db:
+        return load_free_matrix(clock.today(), db)
+
+
+def load_room_attributes() -> Dict[Tuple[str, ...], RoomAttributes]:
+    with closing(connect()) as db:
+        return stored_room_attributes(db)
+
+
+def room_attributes_generation() -> int:
+    with closing(connect()) as db:
+        return room_attributes_version(db)
+
+
+# datasets kept in memory, reloaded in the background when the crawler (or the process itself) updates them
+BUILDING_NAMES: Resident[BuildingNameIndex] = Resident(
+    "building names",
+    lambda: BuildingNameIndex(reread_cached_file(all_buildings, "BUILDING_LIST")),
+    cached_file_generation(all_buildings, "BUILDING_LIST"),
+)
+BUILDING_INDEX: Resident[BuildingIndex] = Resident(
+    "building index",
+    lambda: BuildingIndex(reread_cached_file(all_located_buildings, "LOCATED_BUILDING_LIST")),
+    cached_file_generation(all_located_buildings, "LOCATED_BUILDING_LIST"),
+)
+# the matrix is joined with the seats and kinds of the rooms, other writes to the database do not change either
+FREE_MATRIX: Resident[Optional[FreeMatrix]] = Resident(
+    "free matrix", load_current_free_matrix,
+    lambda: (file_generation(lambda: campus_grid_path(clock.today())), room_attributes_generation()),
+)
+ROOM_ATTRIBUTES: Resident[Dict[Tuple[str, ...], RoomAttributes]] = Resident(
+    "room attributes", load_room_attributes, room_attributes_generation
+)
+
+
+def prefetch_week(day: date):
+    """
+    Fetches the occupancy of all rooms in the week of day that is not stored yet and stores the campus grid of the week
+    """
+    __LOGGER__.info(f"Prefetching the week of {day}")
+    with closing(connect()) as db:
+        sync_occupancy(db, stored_rooms(db), day)
+        store_campus_grid(db, day)
+    FREE_MATRIX.reload()
+
+
+def on_new_day(previous: date, day: date):
+    # fetch the new week in the background right at midnight, instead of on the first requests of monday morning
+    if week_start(day) != week_start(previous):
+        prefetch_week(day)
+
+
+def resident_room_attributes(r: Room) -> RoomAttributes:
+    """
+    Returns the attributes of a room from memory, from the database (or Rauminfo) only if they were never stored
+    """
+    attributes = ROOM_ATTRIBUTES.get().get(room_key(r))
+    if attributes is None:
+        with closing(connect()) as db:
+            attributes = room_attributes(stored_room_info(db, r))
+    return attributes
+
+
+def building_names() -> BuildingNameIndex:
+    return BUILDING_NAMES.get()
+
+
+def located_building(name: str) -> Optional[LocatedBuilding]:
+    return BUILDING_INDEX.get().building(name)
+
+
+def room_kinds() -> List[str]:
+    """
+    Returns all known room kinds
+    """
+    return sorted({a.kind for a in ROOM_ATTRIBUTES.get().values() if a.kind})
+
+
+def _check_order(order_by: str):
+    if order_by not in ORDERS:
+        raise ValueError(f"Unknown order {order_by}, expected one of {', '.join(ORDERS)}")
+
+
+def iter_free_rooms(
+    rooms: Iterable[Room],
+    at: datetime,
+    order_by: str = "building",
+    limit: Optional[int] = None,
+    location: Optional[Tuple[float, float]] = None,
+    minutes: float = 0,
+    states: Set[Occupancy] = FREE_STATES,
+    max_workers: int = MAX_WORKERS,
+    with_attributes: bool = True,
+) -> Iterator[FreeRoom]:
+    """
+    Yields the rooms that are in one of states at at (and stay so for at least minutes) as soon as they are known.
+    Stored occupancies are read at once, missing ones are fetched concurrently at most 2 * max_workers rooms ahead,
+    and nothing more is fetched once limit rooms were yielded or the iteration is stopped.
+    No database connection is held while suspended, so the generator can be resumed from another thread.
+    :param rooms:
+    :param at:
+    :param order_by: building by building code and then in the order of rooms (like the free matrix), distance is nearest to location first, seats most seats first,
+        free_until longest free first (which is only known once all rooms were looked at)
+    :param limit: number of rooms to yield at most, all if None
+    :param location: (lat, lon) the distances are measured to, rooms of buildings that were not located are skipped
+    :param minutes:
+    :param states:
+    :param max_workers: number of rooms fetched in parallel
+    :param with_attributes: fetch the attributes of rooms that were never stored, otherwise they are left unknown
+    :return:
+    """
+    _check_order(order_by)
+    if order_by == "distance" and location is None:
+        raise ValueError("Ordering by distance needs a location")
+    rooms = list(rooms)
+    # only 7:00 - 22:00 is parsed, no room is free during the night and runs end at 22:00 (like in the free matrix)
+    day_begin = at.replace(hour=0, minute=0, second=0, microsecond=0) + DAY_BEGIN
+    day_end = day_begin + SLOTS_PER_DAY * SLOT
+    if not rooms or (limit is not None and limit <= 0) or not day_begin <= at < day_end:
+        return
+    distances: Dict[str, float] = {}
+    if location is not None:
+        names = sorted({r.gebaeude for r in rooms})
+        distances = dict(zip(names, map(float, BUILDING_INDEX.get().distances_to(*location, names))))
+        rooms = [r for r in rooms if distances[r.gebaeude] < float("inf")]
+    # copied, as the attributes of fetched rooms are added
+    attributes = dict(ROOM_ATTRIBUTES.get())
+    with closing(connect()) as db:
+        if order_by == "seats":
+            # the order needs the seats of all rooms up front
+            sync_room_infos(db, [r for r in rooms if room_key(r) not in attributes])
+            attributes = stored_room_attributes(db)
+    stored: Dict[Tuple[str, ...], List[Timeslot]] = {}
+    # buildings whose stored occupancies were read
+    read: Set[str] = set()
+
+    def read_stored(buildings: Set[str]):
+        with closing(connect()) as db:
+            stored.update((room_key(r), t) for r, t in stored_occupancies(db, at.date(), buildings - read))
+        read.update(buildings)
+
+    # a limited walk in building or distance order reads the buildings as they are reached, i.e. only those of a page
+    lazy = limit is not None and order_by in ("building", "distance")
+    if not lazy:
+        read_stored({r.gebaeude for r in rooms})
+    if order_by == "seats":
+        rooms.sort(key=lambda r: -attributes.get(room_key(r), RoomAttributes(None, 0)).seats)
+    elif order_by == "distance":
+        rooms.sort(key=lambda r: distances[r.gebaeude])
+    elif order_by == "building":
+        rooms.sort(key=lambda r: r.gebaeude)
+
+    def missing(r: Room) -> bool:
+        if r.gebaeude not in read:
+            read_stored({r.gebaeude})
+        return room_key(r) not in stored or (with_attributes and room_key(r) not in attributes)
+
+    def fetch(r: Room) -> Tuple[Optional[CachedRoomOccupancy], Optional[Dict[str, str]]]:
+        key = room_key(r)
+        return (
+            room_occupancy_week(r, at.date()) if key not in stored else None,
+            room_info(r) if with_attributes and key not in attributes else None,
+        )
+
+    # fetches the missing rooms in the order they are reached, lazily and a bounded window ahead
+    fetched = fetch_concurrently(fetch, filter(missing, rooms), max_workers)
+
+    def free_room(r: Room) -> Optional[FreeRoom]:
+        key = room_key(r)
+        if missing(r):
+            _, (week, info) = next(fetched)
+            with closing(connect()) as db:
+                if week is not None:
+                    store_occupancy(db, r, week)
+                    stored[key] = week.data
+                if info is not None:
+                    store_room_info(db, r, info)
+                    attributes[key] = room_attributes(info)
+        intervals = RoomIntervals(stored[key])
+        slot = intervals.slot_at(at, states)
+        if slot is None:
+            return None
+        until = min(intervals.free_until(at, states), day_end)
+        if until <= at or until - at < timedelta(minutes=minutes):
+            return None
+        return FreeRoom(r, slot.state, until, attributes.get(key, RoomAttributes()), distances.get(r.gebaeude))
+
+    found = (f for f in map(free_room, rooms) if f is not None)
+    try:
+        if order_by == "free_until":
+            if limit is None:
+                yield from sorted(found, key=lambda f: f.until, reverse=True)
+            else:
+                yield from heapq.nlargest(limit, found, key=lambda f: f.until)
+        else:
+            yield from islice(found, limit)
+    finally:
+        # cancels the fetches that were not started yet
+        fetched.close()
+
+
+def free_rooms_in_buildings(
+    buildings: Optional[Set[str]],
+    now: datetime,
+    room_filter: Optional[RoomFilter] = None,
+    minutes: float = 0,
+    order_by: str = "building",
+    limit: Optional[int] = None,
+    states: Set[Occupancy] = FREE_STATES,
+) -> Iterator[FreeRoom]:
+    """
+    Yields the rooms in buildings (all if None) accepted by room_filter that are in one of states at now
+    (and stay so for at least minutes), see iter_free_rooms for the orders
+    """
+    _check_order(order_by)
+    if order_by == "distance":
+        raise ValueError("Ordering by distance needs a location, see nearest_free_rooms")
+    matrix = FREE_MATRIX.get()
+    if matrix is not None:
+        # the crawler stored the whole campus, which is resident in memory
+        free_minutes = matrix.free_minutes(now, states)
+        mask = (free_minutes >= max(minutes, 1e-9)) & matrix.matching(room_filter)
+        if buildings is not None:
+            mask &= matrix.in_buildings(buildings)
+        keys = {"building": matrix.building_codes, "seats": -matrix.seats, "free_until": -free_minutes}
+        states = matrix.state_at(now)
+        for i in islice(matrix.rank(mask, keys[order_by]), limit):
+            r = matrix.rooms[i]
+            yield FreeRoom(r, states[i], now + timedelta(minutes=float(free_minutes[i])), resident_room_attributes(r))
+        return
+    with closing(connect()) as db:
+        # rooms the filter rejects are dropped before their occupancy is fetched
+        rooms = stored_rooms(db, buildings, room_filter)
+    yield from iter_free_rooms(rooms, now, order_by, limit, minutes=minutes, states=states)
+
+
+def free_seats_by_building(
+    now: datetime, room_filter: Optional[RoomFilter] = None, minutes: float = 0
+) -> List[Tuple[str, int, int]]:
+    """
+    Returns (building, free rooms, free seats) of all buildings with free rooms at now, most free seats first
+    """
+    matrix = FREE_MATRIX.get()
+    if matrix is not None:
+        # counted per building in one go
+        aggregated = matrix.by_building(matrix.free_for(now, minutes) & matrix.matching(room_filter))
+    else:
+        aggregated = defaultdict(lambda: (0, 0))
+        for f in free_rooms_in_buildings(None, now, room_filter, minutes):
+            r, s = aggregated[f.room.gebaeude]
+            aggregated[f.room.gebaeude] = (r + 1, s + f.attributes.seats)
+    return sorted(((b, r, s) for b, (r, s) in aggregated.items()), key=lambda x: -x[2])
+
+
+def nearest_rooms(lat: float, lon: float) -> List[Room]:
+    """
+    Returns the rooms of located buildings ordered by the distance of their building to (lat, lon),
+    in the order nearest_free_rooms looks at them
+    """
+    index = BUILDING_INDEX.get()
+    matrix = FREE_MATRIX.get()
+    if matrix is not None:
+        distances = index.distances_to(lat, lon, matrix.buildings)[matrix.building_codes]
+        return [matrix.rooms[i] for i in matrix.rank(np.isfinite(distances), distances)]
+    with closing(connect()) as db:
+        rooms = stored_rooms(db, [b.name for b in index.buildings])
+    names = sorted({r.gebaeude for r in rooms})
+    distances = dict(zip(names, index.distances_to(lat, lon, names)))
+    return sorted(rooms, key=lambda r: distances[r.gebaeude])
+
+
+def nearest_free_rooms(
+    lat: float, lon: float, now: datetime, limit: Optional[int] = None, rooms: Optional[List[Room]] = None
+) -> Iterator[FreeRoom]:
+    """
+    Yields the free rooms of located buildings ordered by the distance of their building to (lat, lon).
+    Only the given rooms are looked at, if any, i.e. the rest of nearest_rooms after the rooms of a previous page.
+    """
+    index = BUILDING_INDEX.get()
+    matrix = FREE_MATRIX.get()
+    if matrix is not None:
+        # the crawler stored the whole campus, select and sort the free rooms in one go
+        free_minutes = matrix.free_minutes(now)
+        distances = index.distances_to(lat, lon, matrix.buildings)[matrix.building_codes]
+        states = matrix.state_at(now)
+        mask = (free_minutes > 0) & np.isfinite(distances)
+        if rooms is not None:
+            mask &= matrix.among(rooms)
+        for i in islice(matrix.rank(mask, distances), limit):
+            r = matrix.rooms[i]
+            yield FreeRoom(
+                r,
+                states[i],
+                now + timedelta(minutes=float(free_minutes[i])),
+                resident_room_attributes(r),
+                float(distances[i]),
+            )
+        return
+    if rooms is None:
+        with closing(connect()) as db:
+            rooms = stored_rooms(db, [b.name for b in index.buildings])
+    # only the rooms of the buildings that are reached are fetched
+    yield from iter_free_rooms(rooms, now, "distance", limit, location=(lat, lon))
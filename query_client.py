@@ -0,0 +1,136 @@
+import json
+import os
+from datetime import datetime
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from free_room import FreeRoom
+from parse_buildings import Building
+from parse_occupancy import Occupancy, FREE_STATES
+from parse_room_info import RoomFilter
+
+if TYPE_CHECKING:
+    from locate_buildings import LocatedBuilding
+    from name_index import BuildingNameIndex
+
+# default port of the query server, on localhost
+SERVER_PORT = 8642
+# seconds to wait for an answer of the query server
+TIMEOUT = 30
+# rooms per request while streaming the nearest free rooms
+PAGE_SIZE = 50
+# number of responses remembered for revalidation with their ETag
+ETAGS = 1024
+
+
+def filter_params(room_filter: Optional[RoomFilter]) -> dict:
+    if not room_filter:
+        return {}
+    return {"type": sorted(room_filter.kinds or []), "min_seats": room_filter.min_seats}
+
+
+class QueryClient:
+    """
+    Client of a query server (see query_server.py), offering the same queries as the queries module.
+    Repeated requests are revalidated with the ETag of their last response.
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self._lock = Lock()
+        # url -> (etag, data) of the last response
+        self._responses: Dict[str, Tuple[str, object]] = {}
+        # the last building list and its index, rebuilt only when the list changed
+        self._names: Optional[Tuple[object, "BuildingNameIndex"]] = None
+
+    def get(self, path: str, **params) -> object:
+        url = f"{self.url}{path}?{urlencode(params, doseq=True)}"
+        with self._lock:
+            cached = self._responses.get(url)
+        request = Request(url, headers={"If-None-Match": cached[0]} if cached is not None else {})
+        try:
+            with urlopen(request, timeout=TIMEOUT) as response:
+                data = json.load(response)
+                etag = response.headers.get("ETag")
+        except HTTPError as e:
+            if e.code == 304 and cached is not None:
+                return cached[1]
+            raise
+        if etag is not None:
+            with self._lock:
+                if len(self._responses) >= ETAGS:
+                    self._responses.clear()
+                self._responses[url] = (etag, data)
+        return data
+
+    def free_rooms_in_buildings(
+        self,
+        buildings: Optional[Iterable[str]],
+        now: datetime,
+        room_filter: Optional[RoomFilter] = None,
+        minutes: float = 0,
+        order_by: str = "building",
+        limit: Optional[int] = None,
+        states: Set[Occupancy] = FREE_STATES,
+    ) -> Iterator[FreeRoom]:
+        params = dict(at=now.isoformat(), minutes=minutes, order=order_by, **filter_params(room_filter))
+        if buildings:
+            params["buildings"] = ",".join(sorted(buildings))
+        if limit is not None:
+            params["limit"] = limit
+        if set(states) != FREE_STATES:
+            params["states"] = ",".join(sorted(s.name for s in states))
+        for data in self.get("/free", **params)["rooms"]:
+            yield FreeRoom.from_json(data)
+
+    def nearest_free_rooms(
+        self, lat: float, lon: float, now: datetime, limit: Optional[int] = None, offset: int = 0
+    ) -> Iterator[FreeRoom]:
+        """
+        Yields up to limit of the nearest free rooms, skipping the first offset of them
+        """
+        end = offset + limit if limit is not None else None
+        while end is None or offset < end:
+            size = PAGE_SIZE if end is None else min(PAGE_SIZE, end - offset)
+            rooms = self.get("/nearest", lat=lat, lon=lon, at=now.isoformat(), offset=offset, limit=size)["rooms"]
+            for data in rooms:
+                yield FreeRoom.from_json(data)
+            if len(rooms) < size:
+                return
+            offset += len(rooms)
+
+    def free_seats_by_building(
+        self, now: datetime, room_filter: Optional[RoomFilter] = None, minutes: float = 0
+    ) -> List[Tuple[str, int, int]]:
+        data = self.get("/buildings", at=now.isoformat(), minutes=minutes, **filter_params(room_filter))
+        return [(b["building"], b["rooms"], b["seats"]) for b in data["buildings"]]
+
+    def room_kinds(self) -> List[str]:
+        return self.get("/kinds")["kinds"]
+
+    def building_names(self) -> "BuildingNameIndex":
+        from name_index import BuildingNameIndex
+
+        data = self.get("/names")
+        names = self._names
+        if names is None or names[0] is not data:
+            names = (data, BuildingNameIndex(Building(**b) for b in data["buildings"]))
+            self._names = names
+        return names[1]
+
+    def located_building(self, name: str) -> Optional["LocatedBuilding"]:
+        from locate_buildings import LocatedBuilding
+
+        data = self.get("/located", name=name)["building"]
+        return LocatedBuilding(**data) if data is not None else None
+
+
+def client_from_environment() -> Optional[QueryClient]:
+    """
+    Returns a client of the query server at FREIRAUM_SERVER (i.e. http://127.0.0.1:8642), None if it is not set
+    """
+    url = os.environ.get("FREIRAUM_SERVER")
+    return QueryClient(url) if url else None
@@ -0,0 +1,237 @@
+"""
+Long running HTTP/JSON server answering free room queries from warm in-memory indexes:
+
+    python3 freiraum.py serve
+
+GET /free?buildings=CAB,HG&at=2024-05-06T10:00&minutes=30&type=Seminar&min_seats=30&order=seats&limit=10&states=FREE
+GET /nearest?lat=47.37&lon=8.55&offset=0&limit=20
+GET /buildings?minutes=60
+GET /kinds
+GET /names
+GET /located?name=HG
+
+at defaults to now. Responses are cached per quarter-hour slot and carry an ETag.
+"""
+import argparse
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import asdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from threading import Lock
+from typing import Callable, Dict, Hashable, List, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from parse_occupancy import Occupancy, FREE_STATES
+from parse_room_info import RoomFilter
+from query_client import SERVER_PORT
+from metrics import span
+import clock
+import queries
+
+__LOGGER__ = logging.getLogger(__name__)
+
+# number of cached responses
+RESPONSES = 4096
+# most rooms returned by /nearest at once
+MAX_LIMIT = 500
+
+Params = Dict[str, List[str]]
+
+
+def slot_of(at: datetime) -> datetime:
+    """
+    Returns the beginning of the quarter-hour containing at, within which the free rooms do not change
+    """
+    return at.replace(minute=at.minute - at.minute % 15, second=0, microsecond=0)
+
+
+def _one(params: Params, name: str, default=None, parse=str):
+    values = params.get(name)
+    if not values or values[0] == "":
+        return default
+    try:
+        return parse(values[0])
+    except ValueError:
+        raise ValueError(f"Invalid {name}: {values[0]}")
+
+
+def _room_filter(params: Params) -> RoomFilter:
+    return RoomFilter(kinds=params.get("type") or None, min_seats=_one(params, "min_seats", 0, int))
+
+
+def _states(value: str) -> Set[Occupancy]:
+    try:
+        return {Occupancy[name] for name in value.split(",")}
+    except KeyError as e:
+        raise ValueError(f"Unknown state {e.args[0]}")
+
+
+def free(params: Params, at: datetime) -> dict:
+    buildings = _one(params, "buildings")
+    rooms = queries.free_rooms_in_buildings(
+        set(buildings.split(",")) if buildings else None,
+        at,
+        _room_filter(params),
+        _one(params, "minutes", 0, float),
+        _one(params, "order", "building"),
+        _one(params, "limit", None, int),
+        _one(params, "states", FREE_STATES, _states),
+    )
+    return {"at": at.isoformat(), "rooms": [f.to_json() for f in rooms]}
+
+
+def nearest(params: Params, at: datetime) -> dict:
+    lat, lon = _one(params, "lat", parse=float), _one(params, "lon", parse=float)
+    if lat is None or lon is None:
+        raise ValueError("lat and lon are required")
+    offset = _one(params, "offset", 0, int)
+    limit = min(_one(params, "limit", 20, int), MAX_LIMIT)
+    rooms = islice(queries.nearest_free_rooms(lat, lon, at, offset + limit), offset, None)
+    return {"at": at.isoformat(), "rooms": [f.to_json() for f in rooms]}
+
+
+def buildings(params: Params, at: datetime) -> dict:
+    by_building = queries.free_seats_by_building(at, _room_filter(params), _one(params, "minutes", 0, float))
+    return {
+        "at": at.isoformat(),
+        "buildings": [{"building": b, "rooms": r, "seats": s} for b, r, s in by_building],
+    }
+
+
+def kinds(params: Params, at: datetime) -> dict:
+    return {"kinds": queries.room_kinds()}
+
+
+def names(params: Params, at: datetime) -> dict:
+    return {"buildings": [asdict(b) for b in queries.building_names().buildings.values()]}
+
+
+def located(params: Params, at: datetime) -> dict:
+    building = queries.located_building(_one(params, "name", ""))
+    return {"building": asdict(building) if building is not None else None}
+
+
+ENDPOINTS: Dict[str, Callable[[Params, datetime], dict]] = {
+    "/free": free,
+    "/nearest": nearest,
+    "/buildings": buildings,
+    "/kinds": kinds,
+    "/names": names,
+    "/located": located,
+}
+
+
+class ResponseCache:
+    """
+    Encoded responses with their ETag, keyed by the request and the datasets they were computed from
+    """
+
+    def __init__(self, maxsize: int = RESPONSES):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._responses: "OrderedDict[Hashable, Tuple[str, bytes]]" = OrderedDict()
+
+    def get(self, key: Hashable, compute: Callable[[], dict]) -> Tuple[str, bytes]:
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                self._responses.move_to_end(key)
+                return response
+        body = json.dumps(compute()).encode()
+        response = (f'"{hashlib.sha1(body).hexdigest()}"', body)
+        with self._lock:
+            self._responses[key] = response
+            while len(self._responses) > self.maxsize:
+                self._responses.popitem(last=False)
+        return response
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+def cache_key(path: str, params: Params, at: datetime) -> Hashable:
+    # rooms that are free at some time in a slot are free for the whole slot, only how long they stay free
+    # changes within the slot, which matters for minutes
+    time_key = slot_of(at) if not _one(params, "minutes", 0, float) else at.replace(second=0, microsecond=0)
+    return (
+        path,
+        tuple(sorted((k, tuple(v)) for k, v in params.items() if k != "at")),
+        time_key,
+        # responses of reloaded datasets are never served
+        queries.FREE_MATRIX.version,
+        queries.ROOM_ATTRIBUTES.version,
+        queries.BUILDING_NAMES.version,
+        queries.BUILDING_INDEX.version,
+    )
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        __LOGGER__.debug(format % args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            self._send(404, json.dumps({"error": f"Unknown endpoint {url.path}"}).encode())
+            return
+        params = parse_qs(url.query)
+        try:
+            at = _one(params, "at", None, datetime.fromisoformat) or clock.now()
+            with span("query", endpoint=url.path):
+                etag, body = RESPONSE_CACHE.get(cache_key(url.path, params, at), lambda: endpoint(params, at))
+        except ValueError as e:
+            self._send(400, json.dumps({"error": str(e)}).encode())
+            return
+        except Exception as e:
+            __LOGGER__.error(f"Failed to answer {self.path}", exc_info=e)
+            self._send(500, json.dumps({"error": str(e)}).encode())
+            return
+        if etag in (t.strip() for t in self.headers.get("If-None-Match", "").split(",")):
+            self._send(304, etag=etag)
+        else:
+            self._send(200, body, etag)
+
+    def _send(self, status: int, body: bytes = b"", etag: str = None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            # answers change at the latest with the next quarter-hour
+            self.send_header("Cache-Control", "max-age=60")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+
+def serve(port: int = SERVER_PORT, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Loads the datasets and returns the server answering queries at http://host:port, call serve_forever to run it
+    """
+    for resident in (queries.BUILDING_NAMES, queries.BUILDING_INDEX, queries.FREE_MATRIX, queries.ROOM_ATTRIBUTES):
+        resident.get()
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="freiraum.py serve", description="Answers free room queries over HTTP.")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    args = parser.parse_args(argv)
+    server = serve(args.port, args.host)
+    clock.watch_days(queries.on_new_day)
+    __LOGGER__.info(f"Answering queries at http://{args.host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
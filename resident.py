@@ -0,0 +1,107 @@
+import logging
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Callable, Generic, Hashable, Optional, TypeVar, Union
+
+__LOGGER__ = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_UNLOADED = object()
+
+
+def file_generation(*paths: Union[Path, Callable[[], Path]]) -> Hashable:
+    """
+    Returns the identity of the current content of paths (mtime and size, None for missing files).
+    Paths may be callables for files that move over time, like the grid of the current week.
+    """
+    generation = []
+    for path in paths:
+        path = Path(path() if callable(path) else path)
+        try:
+            stat = path.stat()
+            generation.append((str(path), stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            generation.append((str(path), None))
+    return tuple(generation)
+
+
+class Resident(Generic[T]):
+    """
+    A dataset that a long running process keeps in memory after the first load.
+    A background thread polls generation() every interval seconds and, if it changed, loads the dataset again
+    and swaps it in at once, so get() returns either the old or the new dataset and never touches the disk.
+    """
+
+    def __init__(self, name: str, load: Callable[[], T], generation: Callable[[], Hashable], interval: float = 10.0):
+        self.name = name
+        self.load = load
+        self.generation = generation
+        self.interval = interval
+        self._value = _UNLOADED
+        self._generation = None
+        # number of loads so far, which identifies the loaded dataset unlike its id (that may be reused)
+        self.version = 0
+        self._lock = Lock()
+        self._stopped = Event()
+        self._watcher: Optional[Thread] = None
+
+    def get(self) -> T:
+        value = self._value
+        if value is _UNLOADED:
+            with self._lock:
+                # another thread may have loaded it while we waited
+                if self._value is _UNLOADED:
+                    self._reload()
+                    self._watch()
+                value = self._value
+        return value
+
+    def reload(self):
+        """
+        Loads the dataset again, regardless of its generation
+        """
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        # read the generation first, a change during the load is picked up by the next poll
+        generation = self.generation()
+        value = self.load()
+        self._value, self._generation, self.version = value, generation, self.version + 1
+        __LOGGER__.info(f"Loaded {self.name} ({generation})")
+
+    def _watch(self):
+        if self._watcher is not None:
+            return
+        self._watcher = Thread(target=self._poll, name=f"resident {self.name}", daemon=True)
+        self._watcher.start()
+
+    def _poll(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if self.generation() != self._generation:
+                    self.reload()
+            except Exception as e:
+                # keep serving the dataset that is loaded
+                __LOGGER__.warning(f"Failed to reload {self.name}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+
+
+def cached_file_generation(cached_f: Callable, key: str) -> Callable[[], Hashable]:
+    """
+    Returns the generation of the file of key in the cache of a function decorated with cache.cached
+    """
+    path = cached_f.cache.path(key)
+    return lambda: file_generation(path)
+
+
+def reread_cached_file(cached_f: Callable, key: str, *args, **kwargs):
+    """
+    Calls cached_f (decorated with cache.cached) after dropping the value of key from memory,
+    such that a reload after a change of cached_file_generation sees the new file
+    """
+    cached_f.cache.forget(key)
+    return cached_f(*args, **kwargs)
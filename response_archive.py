@@ -0,0 +1,186 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, Mapping, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+
+__LOGGER__ = logging.getLogger(__name__)
+
+ARCHIVE_PATH = Path(".cache").joinpath("archive")
+# response headers that are kept, such that replayed responses behave like the recorded ones
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+class ArchiveMiss(requests.RequestException):
+    """
+    Raised in replay mode for requests that were never recorded
+    """
+
+
+def request_key(method: str, url: str, data: Optional[Mapping[str, str]] = None) -> str:
+    key = f"{method.upper()} {url}"
+    if data:
+        key += " " + urlencode(sorted(data.items()))
+    return key
+
+
+@dataclass
+class ArchivedResponse:
+    # sha256 of the body, which is stored compressed in objects/
+    digest: str
+    status: int
+    encoding: Optional[str]
+    headers: Dict[str, str]
+    # time.time() at which the response was recorded
+    fetched: float
+
+
+class ResponseArchive:
+    """
+    Raw responses stored content addressed: every distinct body is kept once, gzip compressed,
+    under objects/ named by its sha256, an append only index maps requests to the body of their latest response
+    """
+
+    def __init__(self, path: Path = ARCHIVE_PATH):
+        self.path = Path(path)
+        self.index_path = self.path.joinpath("index.jsonl")
+        self._lock = Lock()
+        self._index: Dict[str, ArchivedResponse] = {}
+        try:
+            with self.index_path.open() as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    key = entry.pop("key")
+                    self._index[key] = ArchivedResponse(**entry)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._index)
+
+    def _object_path(self, digest: str) -> Path:
+        return self.path.joinpath("objects", digest[:2], digest[2:] + ".gz")
+
+    def record(self, key: str, response: requests.Response):
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self._object_path(digest)
+        if not object_path.exists():
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=object_path.parent, suffix=".tmp")
+            with open(fd, "wb") as tmp_file, gzip.GzipFile(fileobj=tmp_file, mode="wb") as object_file:
+                object_file.write(body)
+            Path(tmp_path).replace(object_path)
+        entry = ArchivedResponse(
+            digest=digest,
+            status=response.status_code,
+            encoding=response.encoding,
+            headers={h: response.headers[h] for h in KEPT_HEADERS if h in response.headers},
+            fetched=time.time(),
+        )
+        with self._lock:
+            self._index[key] = entry
+            with self.index_path.open("a") as index_file:
+                index_file.write(json.dumps({"key": key, **asdict(entry)}) + "\n")
+
+    def body(self, entry: ArchivedResponse) -> bytes:
+        with gzip.open(self._object_path(entry.digest), "rb") as object_file:
+            return object_file.read()
+
+    def replay(self, key: str, url: str) -> requests.Response:
+        """
+        Returns the recorded response of key as if it was just fetched, raises ArchiveMiss if there is none
+        """
+        entry = self._index.get(key)
+        if entry is None:
+            raise ArchiveMiss(f"{key} is not archived")
+        response = requests.Response()
+        response.status_code = entry.status
+        response.encoding = entry.encoding
+        response.headers.update(entry.headers)
+        response.url = url
+        response._content = self.body(entry)
+        return response
+
+    def entries(self, prefix: str = "") -> Iterator[Tuple[str, ArchivedResponse]]:
+        """
+        Yields the archived requests whose key starts with prefix, i.e. "POST http://..." for all requests to a url
+        """
+        for key, entry in list(self._index.items()):
+            if key.startswith(prefix):
+                yield key, entry
+
+    def texts(self, prefix: str = "") -> Iterator[Tuple[str, str]]:
+        """
+        Yields the decoded bodies of the archived requests whose key starts with prefix
+        """
+        for key, entry in self.entries(prefix):
+            yield key, self.body(entry).decode(entry.encoding or "utf-8", errors="replace")
+
+
+def reparse(archive: ResponseArchive):
+    """
+    Parses all archived occupancy and room info pages offline and reports how long it took
+    """
+    from parse_occupancy import OCCUPANCY_URL, parse_occupancy_page
+    from parse_room_info import ROOM_URL, parse_room_info_page
+
+    for name, prefix, parse in (
+        ("occupancy", f"POST {OCCUPANCY_URL}", parse_occupancy_page),
+        ("room info", f"GET {ROOM_URL.split('?')[0]}", parse_room_info_page),
+    ):
+        pages = list(archive.texts(prefix))
+        failed = 0
+        begin = time.perf_counter()
+        for key, site in pages:
+            try:
+                parse(site)
+            except Exception as e:
+                failed += 1
+                __LOGGER__.warning(f"Failed to parse {key}: {e}")
+        elapsed = time.perf_counter() - begin
+        print(f"Parsed {len(pages)} {name} pages in {elapsed:.2f}s ({failed} failed)")
+
+
+def export(archive: ResponseArchive, directory: Path, limit: Optional[int] = None) -> int:
+    """
+    Writes the archived occupancy pages to directory (i.e. tests/pages), each distinct page once, named by its digest.
+    Returns the number of pages written.
+    """
+    from parse_occupancy import OCCUPANCY_URL
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    written = 0
+    for key, entry in archive.entries(f"POST {OCCUPANCY_URL}"):
+        if limit is not None and written >= limit:
+            break
+        path = directory.joinpath(f"recorded_{entry.digest[:16]}.html")
+        if path.exists():
+            continue
+        path.write_bytes(archive.body(entry))
+        written += 1
+    return written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Reparses the archived raw responses offline.")
+    parser.add_argument("--archive", type=Path, default=ARCHIVE_PATH, help="Directory of the archive.")
+    parser.add_argument("--export", type=Path,
+                        help="Writes the archived occupancy pages to this directory (i.e. tests/pages) instead.")
+    parser.add_argument("--limit", type=int, help="Number of pages to export at most.")
+    args = parser.parse_args()
+    if args.export:
+        print(f"Exported {export(ResponseArchive(args.archive), args.export, args.limit)} occupancy pages")
+    else:
+        reparse(ResponseArchive(args.archive))
@@ -0,0 +1,133 @@
+"""
+A precompiled snapshot of the stored rooms, their attributes and their occupancy in one week, saved as a single
+memory mapped campus grid, such that freiraum.py answers cached queries without opening the database
+or importing the scraping stack.
+"""
+import logging
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+
+from free_room import room_key
+from occupancy_grid import CampusGrid, DAYS, DAY_BEGIN, SLOT, SLOTS_PER_DAY, SLOTS_PER_WEEK, STATE_CODES, week_start
+from parse_occupancy import Room, Occupancy
+from parse_room_info import RoomAttributes, RoomFilter
+
+__LOGGER__ = logging.getLogger(__name__)
+
+
+def snapshot_path(d: date, cache=Path(".cache")) -> Path:
+    return Path(cache).joinpath(f"snapshot_{week_start(d):%Y-%m-%d}.grid")
+
+
+class Snapshot:
+    """
+    The stored rooms of one week with their occupancy, and their attributes where they are known
+    """
+
+    def __init__(self, grid: CampusGrid):
+        self.grid = grid
+        attributes = grid.meta.get("attributes") or [None] * len(grid.rooms)
+        self.attributes: List[Optional[RoomAttributes]] = [
+            RoomAttributes(*a) if a is not None else None for a in attributes
+        ]
+        # rooms whose occupancy of the week was not stored, as their state is unknown
+        self.unfetched: Set[int] = set(grid.meta.get("unfetched", []))
+
+    def free_rooms(
+        self,
+        at: datetime,
+        buildings: Iterable[str] = (),
+        room_filter: Optional[RoomFilter] = None,
+        minutes: float = 0,
+        order_by: str = "building",
+        limit: Optional[int] = None,
+        states: Set[Occupancy] = frozenset({Occupancy.FREE}),
+    ) -> Optional[List[Tuple[Room, datetime]]]:
+        """
+        Returns the rooms in buildings (all if empty) accepted by room_filter that are in one of states at at
+        and stay so for at least minutes, with the end of that time, like queries.iter_free_rooms.
+        None if the snapshot cannot answer: at is outside of its week,
+        the buildings are unknown or some of the rooms (or their attributes) were never fetched.
+        """
+        if order_by not in ("building", "seats", "free_until"):
+            return None
+        day, time = divmod(at - self.grid.week_begin, timedelta(days=1))
+        if not 0 <= day < DAYS:
+            return None
+        if not DAY_BEGIN <= time < DAY_BEGIN + SLOTS_PER_DAY * SLOT:
+            # only 7:00 - 22:00 is parsed, no room is free during the night (like in queries.iter_free_rooms)
+            return []
+        slot, into_slot = divmod(time - DAY_BEGIN, SLOT)
+        buildings = set(buildings)
+        candidates = [i for i, r in enumerate(self.grid.rooms) if not buildings or r.gebaeude in buildings]
+        if not candidates or (buildings and buildings - {self.grid.rooms[i].gebaeude for i in candidates}):
+            return None
+        if room_filter or order_by == "seats":
+            if any(self.attributes[i] is None for i in candidates):
+                return None
+            if room_filter:
+                candidates = [i for i in candidates if room_filter.accepts(self.attributes[i])]
+        if any(i in self.unfetched for i in candidates):
+            return None
+        codes = {STATE_CODES[s] for s in states}
+        day_begin = self.grid.week_begin + timedelta(days=day) + DAY_BEGIN
+        result = []
+        for i in candidates:
+            first = i * SLOTS_PER_WEEK + day * SLOTS_PER_DAY
+            day_states = self.grid.states[first:first + SLOTS_PER_DAY]
+            start = slot
+            # like for the timeslots, a point in time at the border of two slots belongs to the earlier one
+            if not into_slot and slot > 0 and day_states[slot - 1] in codes:
+                start = slot - 1
+            end = start
+            while end < SLOTS_PER_DAY and day_states[end] in codes:
+                end += 1
+            until = day_begin + end * SLOT
+            if until > at and until - at >= timedelta(minutes=minutes):
+                result.append((i, until))
+        if order_by == "building":
+            result.sort(key=lambda x: self.grid.rooms[x[0]].gebaeude)
+        elif order_by == "seats":
+            result.sort(key=lambda x: -self.attributes[x[0]].seats)
+        elif order_by == "free_until":
+            result.sort(key=lambda x: x[1], reverse=True)
+        return [(self.grid.rooms[i], until) for i, until in result[:limit]]
+
+
+def store_snapshot(conn, day: date, cache=Path(".cache")):
+    """
+    Precompiles the rooms, attributes and occupancies of the week of day stored in the database conn into the snapshot
+    """
+    from database import missing_rooms, stored_occupancies, stored_room_attributes, stored_rooms
+
+    rooms = stored_rooms(conn)
+    occupancies = {room_key(r): timeslots for r, timeslots in stored_occupancies(conn, day)}
+    attributes = stored_room_attributes(conn)
+    unfetched = {room_key(r) for r in missing_rooms(conn, rooms, day)}
+    meta = {
+        "attributes": [
+            [a.kind, a.seats] if a is not None else None for a in (attributes.get(room_key(r)) for r in rooms)
+        ],
+        "unfetched": [i for i, r in enumerate(rooms) if room_key(r) in unfetched],
+    }
+    grid = CampusGrid.from_occupancies(week_start(day), ((r, occupancies.get(room_key(r), [])) for r in rooms), meta)
+    grid.save(snapshot_path(day, cache))
+
+
+def load_snapshot(d: date, sources: Iterable[Path] = (), cache=Path(".cache")) -> Optional[Snapshot]:
+    """
+    Loads the snapshot of the week of d, None if there is none or it is older than one of sources
+    (i.e. the database it was compiled from)
+    """
+    path = snapshot_path(d, cache)
+    try:
+        modified = path.stat().st_mtime
+        if any(Path(s).stat().st_mtime > modified for s in sources if Path(s).exists()):
+            return None
+        return Snapshot(CampusGrid.load(path))
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        __LOGGER__.warning(f"Ignoring the snapshot at {path}: {e}")
+        return None
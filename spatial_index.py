@@ -0,0 +1,64 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from locate_buildings import LocatedBuilding
+
+# mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+
+class BuildingIndex:
+    """
+    The coordinates of all located buildings in arrays, such that the distances from a location to all buildings
+    are computed in one vectorized haversine instead of one geodesic per building
+    """
+
+    def __init__(self, buildings: Iterable[LocatedBuilding]):
+        self.buildings: List[LocatedBuilding] = list(buildings)
+        self.lat = np.radians([b.lat for b in self.buildings])
+        self.lon = np.radians([b.lon for b in self.buildings])
+        self.cos_lat = np.cos(self.lat)
+        self._index: Dict[str, int] = {b.name: i for i, b in enumerate(self.buildings)}
+
+    def __len__(self):
+        return len(self.buildings)
+
+    def building(self, name: str) -> Optional[LocatedBuilding]:
+        i = self._index.get(name)
+        return self.buildings[i] if i is not None else None
+
+    def distances(self, lat: float, lon: float) -> np.ndarray:
+        """
+        Returns the distance in meters from (lat, lon) to every building
+        """
+        lat, lon = np.radians(lat), np.radians(lon)
+        a = np.sin((self.lat - lat) / 2) ** 2 + np.cos(lat) * self.cos_lat * np.sin((self.lon - lon) / 2) ** 2
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+    def distances_to(self, lat: float, lon: float, names: Iterable[str]) -> np.ndarray:
+        """
+        Returns the distance in meters from (lat, lon) to the buildings with names, inf for unknown buildings
+        """
+        distances = np.append(self.distances(lat, lon), np.inf)
+        return distances[[self._index.get(n, len(self.buildings)) for n in names]]
+
+    def nearest(self, lat: float, lon: float, k: int) -> List[Tuple[LocatedBuilding, float]]:
+        """
+        Returns the k nearest buildings to (lat, lon) and their distance, nearest first
+        """
+        distances = self.distances(lat, lon)
+        k = min(k, len(distances))
+        if k <= 0:
+            return []
+        # only the k nearest are sorted
+        candidates = np.argpartition(distances, k - 1)[:k]
+        return [(self.buildings[i], float(distances[i])) for i in candidates[np.argsort(distances[candidates])]]
+
+    def iter_nearest(self, lat: float, lon: float) -> Iterator[Tuple[LocatedBuilding, float]]:
+        """
+        Yields all buildings and their distance to (lat, lon), nearest first
+        """
+        distances = self.distances(lat, lon)
+        for i in np.argsort(distances, kind="stable"):
+            yield self.buildings[i], float(distances[i])
@@ -0,0 +1,154 @@
+"""
+Coalescing of the requests of a user and streaming of replies, against a fake bot
+"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import bot_helpers
+from bot_helpers import MESSAGE_LIMIT, SUPERSEDED_TEXT, Coalescer, ReplyStream, coalesced
+
+
+class FakeBot:
+    def __init__(self):
+        # texts of the sent messages by message_id, as they are after all edits
+        self.messages = {}
+        self.edits = 0
+
+    def send_message(self, chat_id, text):
+        message = SimpleNamespace(message_id=len(self.messages), chat_id=chat_id)
+        self.messages[message.message_id] = text
+        return message
+
+    def edit_message_text(self, text, chat_id, message_id):
+        assert text != self.messages[message_id]
+        self.messages[message_id] = text
+        self.edits += 1
+
+
+@pytest.fixture
+def monotonic(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(bot_helpers.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_reply_is_edited_at_most_every_interval(monotonic):
+    bot = FakeBot()
+    reply = ReplyStream(bot, 1, "header")
+    reply.add("a")
+    reply.add("b")
+    assert bot.edits == 0
+    monotonic[0] += bot_helpers.EDIT_INTERVAL
+    reply.add("c")
+    assert bot.edits == 1 and bot.messages[0] == "header\na\nb\nc"
+    reply.close()
+    assert bot.edits == 1
+
+
+def test_reply_crossing_message_limit(monotonic):
+    bot = FakeBot()
+    reply = ReplyStream(bot, 1, "header")
+    lines = [str(i) * 1000 for i in range(10)]
+    for line in lines:
+        reply.add(line)
+    reply.close()
+    assert len(bot.messages) == 3
+    assert all(len(text) <= MESSAGE_LIMIT for text in bot.messages.values())
+    assert "\n".join(bot.messages.values()).split("\n") == ["header"] + lines
+    assert reply.count == len(lines)
+
+
+def test_empty_reply():
+    bot = FakeBot()
+    ReplyStream(bot, 1, "header").close("nothing found")
+    assert bot.messages == {0: "header\nnothing found"}
+
+
+def run_blocking(coalescer, key, name, log, superseded_log=None):
+    """
+    Submits a request in a thread of its own that blocks until its returned event is set
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def request():
+        log.append(name)
+        started.set()
+        release.wait(5)
+
+    superseded = (lambda: superseded_log.append(name)) if superseded_log is not None else None
+    thread = threading.Thread(target=lambda: coalescer.submit(key, request, superseded))
+    thread.start()
+    assert started.wait(5)
+    return thread, release
+
+
+def test_request_queued_while_another_runs():
+    coalescer = Coalescer()
+    log = []
+    thread, release = run_blocking(coalescer, "user", "first", log)
+    # the second request is run by the thread of the first one, after it
+    assert not coalescer.submit("user", lambda: log.append("second"))
+    assert log == ["first"]
+    # requests of other users are not held up
+    assert coalescer.submit("other", lambda: log.append("other"))
+    release.set()
+    thread.join(5)
+    assert log == ["first", "other", "second"]
+    assert coalescer.submit("user", lambda: log.append("third"))
+    assert log[-1] == "third"
+
+
+def test_superseded_request_never_runs():
+    coalescer = Coalescer()
+    log, superseded = [], []
+    thread, release = run_blocking(coalescer, "user", "first", log, superseded)
+    assert not coalescer.submit("user", lambda: log.append("second"), lambda: superseded.append("second"))
+    assert not coalescer.submit("user", lambda: log.append("third"), lambda: superseded.append("third"))
+    assert superseded == ["second"]
+    release.set()
+    thread.join(5)
+    assert log == ["first", "third"]
+    assert superseded == ["second"]
+
+
+def test_failing_request_does_not_block_the_next():
+    coalescer = Coalescer()
+    log = []
+
+    def fail():
+        raise RuntimeError("failed")
+
+    assert coalescer.submit("user", fail)
+    assert coalescer.submit("user", lambda: log.append("next"))
+    assert log == ["next"]
+
+
+def test_coalesced_handler_answers_superseded_requests():
+    coalescer = Coalescer()
+    bot = FakeBot()
+    started, release = threading.Event(), threading.Event()
+    handled = []
+
+    @coalesced(coalescer)
+    def handler(update, context):
+        handled.append(update.message)
+        started.set()
+        release.wait(5)
+
+    def update(message):
+        return SimpleNamespace(
+            message=message, effective_user=SimpleNamespace(id=7), effective_chat=SimpleNamespace(id=1)
+        )
+
+    context = SimpleNamespace(bot=bot)
+    thread = threading.Thread(target=handler, args=(update("first"), context))
+    thread.start()
+    assert started.wait(5)
+    handler(update("second"), context)
+    handler(update("third"), context)
+    release.set()
+    thread.join(5)
+    assert handled == ["first", "third"]
+    assert list(bot.messages.values()) == [SUPERSEDED_TEXT]
@@ -0,0 +1,133 @@
+"""
+Expiry, eviction and shared computations of the two tier cache
+"""
+import pickle
+import threading
+import time
+
+import pytest
+
+import cache
+from cache import Cache, CacheEntry, SingleFlight
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_expiry(tmp_path, clock):
+    c = Cache(tmp_path, ttl=10)
+    calls = []
+    compute = lambda: calls.append(1) or len(calls)
+    assert c.get("k", compute) == 1
+    clock[0] += 5
+    assert c.get("k", compute) == 1
+    clock[0] += 6
+    assert c.get("k", compute) == 2
+    # values whose ttl is None never expire
+    clock[0] += 100
+    assert c.get("k", compute, ttl=lambda v: None) == 2
+
+
+def test_eviction_order(tmp_path):
+    size = len(pickle.dumps(CacheEntry(b"x" * 100, time.time())))
+    c = Cache(tmp_path, max_bytes=int(2.5 * size))
+    for key in ("a", "b"):
+        c.store(key, b"x" * 100)
+    # a was used after b, so b is evicted first
+    assert c.load("a") is not None
+    c.store("c", b"x" * 100)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c"]
+    assert c.load("b") is None
+
+
+def test_stale_while_revalidate(tmp_path, clock):
+    c = Cache(tmp_path, ttl=10, stale_while_revalidate=True)
+    c.get("k", lambda: "old")
+    clock[0] += 11
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return "new"
+
+    # the expired value is returned while it is recomputed in the background
+    assert c.get("k", compute) == "old"
+    assert started.wait(5)
+    (revalidation,) = [t for t in threading.enumerate() if t.name == "revalidate k"]
+    assert revalidation.daemon
+    assert c.get("k", compute) == "old"
+    release.set()
+    revalidation.join(5)
+    assert c.get("k", lambda: "unused") == "new"
+
+
+def test_legacy_files_are_moved(tmp_path):
+    legacy_dir = tmp_path.joinpath("old")
+    legacy_dir.mkdir()
+    legacy_dir.joinpath("k").write_bytes(pickle.dumps(["value"]))
+    c = Cache(tmp_path.joinpath("new"), ttl=10, legacy_dir=legacy_dir)
+    assert c.get("k", lambda: ["computed"]) == ["value"]
+    assert not legacy_dir.joinpath("k").exists()
+    assert Cache(tmp_path.joinpath("new")).load("k").value == ["value"]
+
+
+def test_single_flight_shares_calls():
+    flight = SingleFlight()
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    def func():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return object()
+
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", func)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", func))) for _ in range(3)]
+    for t in followers:
+        t.start()
+    # the followers are waiting for the leader
+    time.sleep(0.05)
+    release.set()
+    for t in [leader] + followers:
+        t.join(5)
+    assert len(calls) == 1
+    assert len(results) == 4 and all(r is results[0] for r in results)
+    # the key is free again once the call finished
+    assert flight.do("k", lambda: 1) == 1
+
+
+def test_single_flight_shares_exceptions():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def func():
+        started.set()
+        release.wait(5)
+        raise ValueError("failed")
+
+    def call():
+        try:
+            flight.do("k", func)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    assert started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
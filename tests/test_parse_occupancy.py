@@ -0,0 +1,42 @@
+"""
+The lxml parser of occupancy pages against the BeautifulSoup parser it replaced
+"""
+from pathlib import Path
+
+import lxml.html
+import pytest
+from bs4 import BeautifulSoup
+
+from parse_occupancy import occupancy_table_bs4, parse_occupancy_page, table_to_2d, table_to_2d_lxml
+
+# pages laid out like those of rauminfo, add recorded ones with
+# `python3 response_archive.py --export tests/pages --limit 10`
+PAGES = sorted(Path(__file__).resolve().parent.joinpath("pages").glob("*.html"))
+
+TABLES = {
+    "colspan_last_cell": '<table><tr><td rowspan="2">a</td><td colspan="3">b</td></tr><tr><td>c</td></tr></table>',
+    "colspan_zero": (
+        '<table><tr><td>a</td><td colspan="0">b</td><td>c</td></tr>'
+        "<tr><td>d</td><td>e</td><td>f</td><td>g</td></tr></table>"
+    ),
+    "rowspan_zero": '<table><tr><td rowspan="0">a</td><td>b</td></tr><tr><td>c</td></tr><tr><td>d</td></tr></table>',
+    "rowspan_outside": '<table><tr><td rowspan="5">a</td><td>b</td></tr><tr><td>c</td></tr></table>',
+    "header_cells": '<table><tr><th>x</th><th colspan="2">y</th></tr><tr><td>1</td><td>2</td><td>3</td></tr></table>',
+    "ragged_rows": '<table><tr><td>a</td></tr><tr><td>b</td><td>c</td><td>d</td></tr></table>',
+}
+
+
+def test_pages_exist():
+    assert PAGES
+
+
+@pytest.mark.parametrize("page", PAGES, ids=lambda p: p.name)
+def test_parsers_agree_on_pages(page):
+    site = page.read_text()
+    assert parse_occupancy_page(site) == parse_occupancy_page(site, occupancy_table_bs4)
+
+
+@pytest.mark.parametrize("html", TABLES.values(), ids=TABLES.keys())
+def test_spans_agree(html):
+    soup = BeautifulSoup(html, features="lxml").find("table")
+    assert table_to_2d_lxml(lxml.html.fragment_fromstring(html)) == table_to_2d(soup)